@@ -1,155 +1,359 @@
 """Runs graph-based genetic algorithm to optimize the SOAP similarity between initial population and target data"""
 
+import os
 import time
-import random
 import argparse
+from functools import partial
+from contextlib import nullcontext
 
 from mpi4py import MPI
 import numpy as np
-from ase import Atoms
 import pandas as pd
 from rdkit import Chem
-from rdkit.Chem import AllChem
-from dscribe.descriptors import SOAP
-from dscribe.kernels import REMatchKernel, AverageKernel
-from sklearn.preprocessing import normalize
 
-from helper import read_xyz, split_by_lengths, return_borders
+from helper import read_xyz, FragmentStore, return_borders, pack_bytes, unpack_bytes, pack_smiles, unpack_smiles
 # The following two are written by Jensen
 import crossover as co
 import mutate as mu
+from soap_fitness import score_population, dedup_population, species_alphabet, cache_key, TargetSOAP
+from mol_cache import MolCache, canonical_smiles
+from checkpoint import save_checkpoint, load_checkpoint
+from timings import StageTimer, TimingLog
+from reproduction import make_children, split_attempts, select_parents, selection_schemes
 
+WORK_TAG, RESULT_TAG = 1, 2 # MPI message tags of the master/worker schedules
 
-def reproduce(population, fitness, mutation_rate):
+
+def reproduce(mpi_comm, mpi_rank, mpi_size, population, fitness, mutation_rate, selection='roulette', tournament_size=4):
     """
     Generates next generation of population by probabilistically choosing mating pool based on fitness, then
     probabilistically reproducing molecules in the mating pool and randomly mutating the children
 
-    :param population: list of RDKit molecules
-    :param fitness: probability distribution of same length as population, returned by pop_fitness
+    Rank 0 chooses the mating pool and broadcasts it, then every rank makes an equal share of the children with its own
+    seed drawn by rank 0 (see reproduction.make_children), and the children are gathered back to rank 0 - so the
+    children for a given seed and number of ranks don't depend on which rank is fastest. Molecules travel as
+    Mol.ToBinary() pickles rather than SMILES, which would re-perceive their aromaticity on the way, so crossover and
+    mutation see exactly the molecules GA-soap.py would.
+
+    :param population: list of RDKit molecules (only needed on rank 0)
+    :param fitness: probability distribution of same length as population, returned by pop_fitness (only needed on rank 0)
     :param mutation_rate: hyperparameter determining the likelihood of mutations occuring
+    :param selection, tournament_size: how the mating pool is chosen, see reproduction.select_parents
+
+    :return: new_population on rank 0, None elsewhere
+    """
+    mating_pool, tasks = None, None
+    if mpi_rank == 0:
+        mating_pool = [population[i] for i in select_parents(fitness, len(population), selection, tournament_size)]
+        seeds, counts = split_attempts(len(population), mpi_size)
+        tasks = list(zip(seeds, counts))
+
+    mating_pool = bcast_mols(mpi_comm, mpi_rank, mating_pool)
+    seed, count = mpi_comm.scatter(tasks, root=0)
+    children = make_children(mating_pool, count, mutation_rate, seed)
+    children = mpi_comm.gather([m.ToBinary() for m in children], root=0)
+    if mpi_rank != 0:
+        return None
+
+    return [Chem.Mol(binary) for rank_children in children for binary in rank_children]
+
+
+def dynamic_schedule(mpi_comm, mpi_rank, mpi_size, smiles, score_batch, batch_size=8):
+    """
+    Master/worker work queue: rank 0 hands out batches of SMILES to the other ranks as they ask for work and collects
+    the fitnesses as they arrive, so that no rank sits idle behind a chunk of slow-to-embed molecules. Rank 0 only
+    coordinates - with a single rank it scores everything itself.
+
+    :param smiles: SMILES to score (only needed on rank 0)
+    :param score_batch: function from a list of SMILES to their fitnesses
+
+    :return: fitness on rank 0, None elsewhere
+    """
+    if mpi_size == 1:
+        return np.array(score_batch(smiles), dtype=float)
+
+    if mpi_rank == 0:
+        fitness = np.zeros(len(smiles))
+        # hand out the largest molecules first, so that the slowest embeddings are started early rather than last
+        order = np.argsort([-len(smi) for smi in smiles], kind='stable')
+        batches = [order[i:i+batch_size].tolist() for i in range(0, len(order), batch_size)]
+        in_flight = {}
+        status = MPI.Status()
+        n_workers = mpi_size - 1
+        while n_workers > 0:
+            # every message from a worker carries its last results and asks for the next batch
+            _, batch_fitness = mpi_comm.recv(source=MPI.ANY_SOURCE, tag=RESULT_TAG, status=status)
+            fitness[in_flight.pop(status.Get_source(), [])] = batch_fitness
+            if batches:
+                in_flight[status.Get_source()] = batches.pop(0)
+                mpi_comm.send([smiles[i] for i in in_flight[status.Get_source()]], dest=status.Get_source(), tag=WORK_TAG)
+            else:
+                mpi_comm.send(None, dest=status.Get_source(), tag=WORK_TAG) # no work left this generation
+                n_workers -= 1
+        return fitness
+
+    work_loop(mpi_comm, score_batch)
+    return None
+
+
+def scatter_smiles(mpi_comm, mpi_rank, mpi_size, smiles):
+    """
+    Splits a list of SMILES (held on rank 0) into contiguous chunks, one per rank, and sends each rank only its own
+    chunk - packed into a single byte buffer plus offsets rather than pickled
+
+    :return: this rank's SMILES, number of SMILES on each rank (on rank 0, None elsewhere)
+    """
+    counts, chunks, byte_counts, byte_displs, buf = None, None, None, None, None
+    if mpi_rank == 0:
+        buf, offsets = pack_smiles(smiles)
+        borders = [return_borders(rank, len(smiles), mpi_size) for rank in range(mpi_size)]
+        counts = np.array([high - low for low, high in borders])
+        chunks = [np.diff(offsets[low:high+1]) for low, high in borders]
+        byte_displs = np.array([offsets[low] for low, high in borders])
+        byte_counts = np.array([offsets[high] - offsets[low] for low, high in borders])
+
+    my_lengths = mpi_comm.scatter(chunks, root=0)
+    my_buf = np.empty(np.sum(my_lengths), dtype=np.uint8)
+    mpi_comm.Scatterv([buf, byte_counts, byte_displs, MPI.BYTE] if mpi_rank == 0 else None, my_buf, root=0)
+    return unpack_smiles(my_buf, np.concatenate(([0], np.cumsum(my_lengths)))), counts
+
+
+def bcast_mols(mpi_comm, mpi_rank, mols):
+    """Sends a list of RDKit molecules held on rank 0 to every rank as Mol.ToBinary() pickles, packed as in
+    scatter_smiles"""
+    buf, offsets = pack_bytes([m.ToBinary() for m in mols]) if mpi_rank == 0 else (None, None)
+    n_bytes, n_offsets = mpi_comm.bcast((len(buf), len(offsets)) if mpi_rank == 0 else None, root=0)
+    if mpi_rank != 0:
+        buf, offsets = np.empty(n_bytes, dtype=np.uint8), np.empty(n_offsets, dtype=np.int64)
+    mpi_comm.Bcast([buf, MPI.BYTE], root=0)
+    mpi_comm.Bcast([offsets, MPI.INT64_T], root=0)
+    return [Chem.Mol(binary) for binary in unpack_bytes(buf, offsets)]
+
+
+def score_smiles(smiles, rcut, sigma, kernel, tgt_atoms, tgt_species, tgt_atoms2=None, **kwargs):
+    """
+    Scores a list of SMILES with soap_fitness.score_population - SMILES that RDKit can't parse get fitness 0
+
+    :param kwargs: passed on to score_population
+    :return: list of fitnesses
+    """
+    mols = [Chem.MolFromSmiles(smi) for smi in smiles]
+    good = [i for i, m in enumerate(mols) if m is not None]
+    fitness = np.zeros(len(mols))
+    fitness[good] = score_population([mols[i] for i in good], rcut, sigma, kernel, tgt_atoms, tgt_species, tgt_atoms2,
+                                     **kwargs)
+    return fitness.tolist()
+
 
-    :return: new_population
+def work_loop(mpi_comm, score_batch):
     """
-    mating_pool = []
-    for i in range(len(population)):
-        mating_pool.append(np.random.choice(population, p=fitness))
-
-    new_population = []
-    for n in range(len(population)):
-        parent_A = random.choice(mating_pool)
-        parent_B = random.choice(mating_pool)
-        # print Chem.MolToSmiles(parent_A),Chem.MolToSmiles(parent_B)
-        new_child = co.crossover(parent_A, parent_B)
-        # print new_child
+    Worker side of the master/worker schedules: sends its last results to rank 0, which answers with the next batch,
+    until rank 0 sends None
+
+    :param score_batch: function from a batch (list) of work items to their fitnesses
+    :return: all the work items scored by this rank
+    """
+    done = []
+    batch, batch_fitness = [], []
+    while True:
+        mpi_comm.send((batch, batch_fitness), dest=0, tag=RESULT_TAG)
+        batch = mpi_comm.recv(source=0, tag=WORK_TAG)
+        if batch is None:
+            return done
+        batch_fitness = score_batch(batch)
+        done += batch
+
+
+def breed(population, fitness, n_children, mutation_rate, max_tries=100, selection='roulette', tournament_size=4):
+    """
+    Makes new molecules by crossover and mutation of parents drawn with probability proportional to fitness - the
+    steady-state counterpart of reproduce
+
+    :param population: list of RDKit molecules
+    :param fitness: raw fitness of the population
+    :param n_children: number of children wanted
+    :param max_tries: give up after max_tries*n_children failed crossovers/mutations
+    :param selection, tournament_size: how the parents are chosen, see reproduction.select_parents
+
+    :return: list of at most n_children RDKit molecules
+    """
+    children = []
+    for _ in range(max_tries*n_children):
+        if len(children) == n_children:
+            break
+        parent_A, parent_B = select_parents(fitness, 2, selection, tournament_size)
+        new_child = co.crossover(population[parent_A], population[parent_B])
         if new_child is not None:
             new_child = mu.mutate(new_child, mutation_rate)
-            # print("after mutation",new_child)
             if new_child is not None:
-                new_population.append(new_child)
+                children.append(new_child)
+    return children
 
-    return new_population
 
+def tournament_replace(population, fitness, child, child_fitness, tournament_size=4):
+    """
+    Inserts a child into the archive in place: tournament_size random members are drawn and the least fit of them is
+    replaced, if the child is fitter
 
-def pop_fitness(mpi_comm, mpi_rank, mpi_size, population, rcut, sigma, kernel, tgt_atoms, tgt_species, tgt_atoms2=None, max_score=[-9999,'']):
+    :return: True if the child was inserted
     """
-    Calculates the fitness (ie SOAP similarity score) of the population by generating conformers for each of the
-    population molecules, then evaluating their SOAP descriptors and calculating its similarity score with the SOAP
-    descriptor of the binding ligand 'field'
+    contestants = np.random.choice(len(population), min(tournament_size, len(population)), replace=False)
+    loser = contestants[np.argmin(fitness[contestants])]
+    if child_fitness > fitness[loser]:
+        population[loser], fitness[loser] = child, child_fitness
+        return True
+    return False
 
-    :param population: list of RDKit molecule objects
-    :param tgt_atoms: list of ASE atom objects of the target ligand field - from read_xyz, second is optional if separate sites
-    :param tgt_species: list of the atomic species present in the target ligand field - from read_xyz
-    :param rcut, sigma: SOAP parameters
-    :param max_score: Maximum SOAP similarity found so far
 
-    :return: fitness, max_score, fit_mean, fit_std
+def steady_state(mpi_comm, mpi_size, population, fitness, n_evals, mutation_rate, score_batch, max_score, f,
+                 batch_size=8, tournament_size=4, cache=None, n_done=0, checkpoint=None, checkpoint_every=1,
+                 timings=None, selection='roulette'):
+    """
+    Steady-state evolution on rank 0 (the workers run work_loop): rank 0 keeps the population as an archive, breeds a
+    batch of children for each worker that asks for work and inserts the scored children by tournament replacement as
+    they come back, so no rank ever waits at a generation barrier. Every len(population) evaluations the champion is
+    printed and written to champions.dat, like a generation of the generational GA.
+
+    :param population, fitness: initial archive and its raw fitness - modified in place
+    :param n_evals: number of children to evaluate
+    :param score_batch: function from a list of SMILES to their fitnesses, only called directly with a single rank
+    :param max_score: Maximum SOAP similarity found so far
+    :param f: open champions.dat file
+    :param cache: optional MolCache on rank 0, the fitnesses reported by the workers are added to it
+    :param n_done: number of evaluations already done, when resuming from a checkpoint
+    :param checkpoint: optional checkpoint file the archive is saved to every checkpoint_every reports - children that
+     are still being scored when it is written are bred again on restart
+    :param timings: optional timings.StageTimer, breeding is recorded as the reproduce stage
+    :param selection: how parents are chosen, see reproduction.select_parents - tournaments use tournament_size too
+
+    :return: max_score
     """
+    status = MPI.Status()
+    in_flight = {}
+    n_workers = mpi_size - 1
+    n_start = n_done
+    n_sent, n_inserted, n_reported = n_done, 0, n_done
     t0 = time.time()
-
-    # partition the population between the MPI cpus
-    my_border_low, my_border_high = return_borders(mpi_rank, len(population), mpi_size)
-    my_pop = population[my_border_low: my_border_high]
- 
-    # loop over RDKit mols and turn them into lists of ASE atom objects for dscribe SOAP atomic feature generation
-    population_ase = []
-    num_list = []
-    species = ['C']
-    bad_mols = []
-    for ind, m in enumerate(my_pop):
-        m = Chem.AddHs(m)
-        conf_result = AllChem.EmbedMolecule(m, maxAttempts=1000)
-        m = Chem.RemoveHs(m)
-        num_list.append(len(m.GetAtoms()))
-        for i, atom in enumerate(m.GetAtoms()): # this is actually wrong, should have an Atoms object for each mol...
-            symbol = atom.GetSymbol()
-            if conf_result != 0:
-                bad_mols.append(ind)
-                population_ase.append(Atoms(symbol, [[0,0,0]]))
+    reproduce_stage = partial(timings.stage, 'reproduce') if timings is not None else nullcontext
+    while n_workers > 0 if mpi_size > 1 else n_sent < n_evals:
+        if mpi_size == 1:
+            with reproduce_stage():
+                children = breed(population, fitness, min(batch_size, n_evals - n_sent), mutation_rate,
+                                 selection=selection, tournament_size=tournament_size)
+            if len(children) == 0:
+                break # breeding keeps failing
+            n_sent += len(children)
+            smiles = [Chem.MolToSmiles(m) for m in children]
+            batch_fitness = score_batch(smiles, count_lookups=True) # no earlier lookup of these children on rank 0
+        else:
+            # every message from a worker carries its last results and asks for the next batch
+            smiles, batch_fitness = mpi_comm.recv(source=MPI.ANY_SOURCE, tag=RESULT_TAG, status=status)
+            children = in_flight.pop(status.Get_source(), [])
+            with reproduce_stage():
+                new_children = breed(population, fitness, min(batch_size, n_evals - n_sent), mutation_rate,
+                                     selection=selection, tournament_size=tournament_size) if n_sent < n_evals else []
+            if len(new_children) > 0:
+                in_flight[status.Get_source()] = new_children
+                n_sent += len(new_children)
+                mpi_comm.send([Chem.MolToSmiles(m) for m in new_children], dest=status.Get_source(), tag=WORK_TAG)
             else:
-                conf = m.GetConformer()
-                population_ase.append(Atoms(symbol, [conf.GetPositions()[i]]))
-            if symbol not in species:  # find unique atomic species for SOAP generation
-                species.append(symbol)
-
-    # Check that we also include the atom types present in the ligand targets
-    for atom in tgt_species:
-        if atom not in species:
-            species.append(atom)
+                mpi_comm.send(None, dest=status.Get_source(), tag=WORK_TAG) # evaluation budget used up
+                n_workers -= 1
+
+        for child, smi, child_fitness in zip(children, smiles, batch_fitness):
+            n_inserted += tournament_replace(population, fitness, child, child_fitness, tournament_size)
+            if child_fitness > max_score[0]:
+                max_score = [child_fitness, smi]
+            if cache is not None and child_fitness > 0:
+                cache.update(canonical_smiles(child), fitness=child_fitness)
+        n_done += len(children)
+
+        if n_done - n_reported >= len(population) or (n_done == n_evals and n_done > n_reported):
+            n_reported = n_done
+            print('\nEvaluations: {}/{}, children inserted: {}, evaluations/s: {:.2f}'.format(
+                n_done, n_evals, n_inserted, (n_done - n_start)/(time.time()-t0)))
+            print('Champion fitness = {}, smiles = {}'.format(max_score[0], max_score[1]))
+            f.write(max_score[1] + '\t' + str(max_score[0]) + '\n')
+            f.flush()
+            if cache is not None and cache.path is not None:
+                cache.save()
+            n_reports = -(-n_done // len(population))
+            if checkpoint is not None and n_reports % checkpoint_every == 0:
+                save_checkpoint(checkpoint, n_reports, population, fitness, max_score, cache=cache, n_done=n_done)
+    return max_score
 
-    t1 = time.time()
-    if mpi_rank==0:
-        print('Time taken to generate conformers: {}'.format(t1-t0))
 
-    # Generate SOAP descriptors using dscribe
-    soap_generator = SOAP(species=species, periodic=False, rcut=rcut, nmax=8, lmax=6, sigma=sigma, sparse=True)
-    soap = soap_generator.create(population_ase)
-    tgt_soap = soap_generator.create(tgt_atoms)
-    if tgt_atoms2 is not None:
-        tgt_soap2 = [normalize(soap_generator.create(tgt_atoms2), copy=False)]
+def pop_fitness(mpi_comm, mpi_rank, mpi_size, population, score_batch, max_score=[-9999,''], cache=None,
+                schedule='static', batch_size=8, raw=False, timings=None):
+    """
+    Calculates the fitness (ie SOAP similarity score) of the population by generating conformers for each of the
+    population molecules, then evaluating their SOAP descriptors and calculating its similarity score with the SOAP
+    descriptor of the binding ligand 'field'.
 
-    # normalize SOAP atom descriptors and group by molecule
-    soap = normalize(soap, copy=False)
-    tgt_soap = [normalize(tgt_soap, copy=False)]
-    soap = split_by_lengths(soap, num_list)
+    Rank 0 collapses duplicates and looks up the fitnesses it already knows, then only the SMILES of the remaining
+    molecules are sent to the other ranks: either split into equal contiguous chunks up front (schedule='static', see
+    scatter_smiles), or handed out in small batches on demand (schedule='dynamic', see dynamic_schedule).
 
-    t2 = time.time()
+    :param population: list of RDKit molecule objects (only needed on rank 0)
+    :param score_batch: function from a list of SMILES to their fitnesses, see score_smiles
+    :param max_score: Maximum SOAP similarity found so far
+    :param cache: optional MolCache of conformers, SOAP descriptors and fitnesses from previous generations (one per
+     rank - the one on rank 0 also collects the fitnesses from every rank)
+    :param schedule: 'static' or 'dynamic'
+    :param batch_size: number of molecules per batch with schedule='dynamic'
+    :param raw: return the raw fitness rather than the normalized probability distribution
+    :param timings: optional timings.StageTimer of this rank - the time spent sending, waiting for and collecting
+     results (beyond this rank's own scoring, which score_batch records) is recorded as the gather stage
+
+    :return: fitness, max_score on rank 0 (fitness is None elsewhere)
+    """
+    todo_smiles = None
     if mpi_rank==0:
-        print('Time taken to generate SOAP descriptors: {}'.format(t2-t1))
+        unique_pop, unique_smiles, inverse = dedup_population(population)
+        print('Unique molecules: {}/{} (dedup ratio {:.3f})'.format(len(unique_pop), len(population),
+                                                                    1 - len(unique_pop)/len(population)))
+        unique_fitness = np.zeros(len(unique_pop))
+        todo = []
+        for ind, smi in enumerate(unique_smiles):
+            cached_fitness = cache.get(smi, 'fitness') if cache is not None else None
+            if cached_fitness is not None:
+                unique_fitness[ind] = cached_fitness
+            else:
+                todo.append(ind)
+        todo_smiles = [unique_smiles[ind] for ind in todo]
 
-    # TODO make REMatch kernel args as input args
-    if kernel == 'rematch':
-        soap_similarity = REMatchKernel(metric="polynomial", degree=3, gamma=1, coef0=0, alpha=0.1, threshold=1e-3, normalize_kernel=True)
-    elif kernel == 'average':
-        soap_similarity = AverageKernel(metric="polynomial", degree=3, gamma=1, coef0=0, normalize_kernel=True)
-    if tgt_atoms2 is not None:
-        fitness1 = soap_similarity.create(soap, tgt_soap)
-        fitness1.flatten()
-        fitness2 = soap_similarity.create(soap, tgt_soap2)
-        fitness2.flatten()
-        # calculate fitness score as product of the two fitnesses
-        fitness = np.multiply(fitness1, fitness2)
-        fitness = np.array([f[0] for f in fitness])
-    else:
-        fitness = soap_similarity.create(soap, tgt_soap)
-        fitness = fitness.flatten()
+    t0 = time.time()
+    with timings.stage('gather') if timings is not None else nullcontext():
+        if schedule == 'dynamic':
+            todo_fitness = dynamic_schedule(mpi_comm, mpi_rank, mpi_size, todo_smiles, score_batch, batch_size)
+        else:
+            my_smiles, counts = scatter_smiles(mpi_comm, mpi_rank, mpi_size, todo_smiles)
+            fitness = np.array(score_batch(my_smiles), dtype=float)
 
-    fitness[bad_mols]=0 # set fitness of bad conformers to 0
-    
-    sendcounts = np.array(mpi_comm.gather(len(fitness),root=0))
+            if mpi_rank==0:
+                todo_fitness = np.empty(len(todo_smiles))
+            else:
+                todo_fitness = None
 
-    if mpi_rank==0:
-        fitness_full = np.empty(len(population))
-    else:
-        fitness_full = None
+            # Gather fitness arrays from MPI cpus into the root cpu
+            mpi_comm.Gatherv(sendbuf=fitness,recvbuf = (todo_fitness, counts),root=0)
 
-    # Gather fitness arrays from MPI cpus into the root cpu, then broadcast the gathered array to all cpus
-    mpi_comm.Gatherv(sendbuf=fitness,recvbuf = (fitness_full, sendcounts),root=0)
-    fitness = mpi_comm.bcast(fitness_full, root=0)
+    if mpi_rank!=0:
+        return None, max_score
 
-    t3 = time.time()
-    if mpi_rank==0:
-        print('Time taken to calculate fitness: {}'.format(t3-t2))
+    print('Time taken to score population: {}'.format(time.time()-t0))
+    unique_fitness[todo] = todo_fitness
+    if cache is not None:
+        for smi, mol_fitness in zip(todo_smiles, todo_fitness):
+            if mol_fitness > 0:
+                cache.update(smi, fitness=mol_fitness)
+        hit_ratio = cache.hit_ratio()
+        print('Cache size: {}, hit ratio: {:.3f}'.format(len(cache), hit_ratio))
+        if timings is not None:
+            timings.cache_hit_ratio = hit_ratio
+
+    # scatter the fitnesses back to all copies of each molecule
+    fitness = unique_fitness[inverse]
 
     # update max_score, include new champion
     if np.amax(fitness) > max_score[0]:
@@ -160,11 +364,11 @@ def pop_fitness(mpi_comm, mpi_rank, mpi_size, population, rcut, sigma, kernel, t
     top_scores = np.flip(fitness[np.argsort(fitness)[-5:]])
     # print(top_scores)
     for i in range(5):
-        if mpi_rank==0:
-            print("Mol {}: {} (fitness = {:.3f})".format(i, Chem.MolToSmiles(population[np.argsort(fitness)[-i-1]]), top_scores[i]))
+        print("Mol {}: {} (fitness = {:.3f})".format(i, Chem.MolToSmiles(population[np.argsort(fitness)[-i-1]]), top_scores[i]))
     
 
-    fitness = fitness / np.sum(fitness)
+    if not raw:
+        fitness = fitness / np.sum(fitness)
 
     return fitness, max_score
 
@@ -173,23 +377,33 @@ def initialise_system(args):
     """
     Reads in a .csv file and generates a population of RDKit molecules, as well as reading in target ligand coordinates
 
-    :param args: system arguments parsed into main - should contain args.csv, args.tgt (and args.tgt2)
+    :param args: system arguments parsed into main - should contain args.csv, args.tgt (and args.tgt2), or args.store
+     and args.site (and args.site2)
 
-    :return: population, tgt_atoms, tg_species
-     or population, tgt_atoms, tgt_species, tgt_atoms2, tgt_species2
+    :return: population, tgt_atoms, tgt_species, tgt_atoms2 - tgt_atoms2 is None without a second site, otherwise
+     tgt_species covers both sites
     """
     population = []
     csv = pd.read_csv(args.csv, header=0)
     for i, row in csv.iterrows():
         population.append(Chem.MolFromSmiles(row['SMILES']))
 
-    tgt_atoms, _, _, tgt_species = read_xyz(args.tgt)
-    if args.tgt2 is not None:
-        tgt_atoms2, _, _, tgt_species2 = read_xyz(args.tgt2)
-        tgt_species = list(set().union(tgt_species, tgt_species2)) # creates a single tgt_species list
-        return population, tgt_atoms, tgt_species, tgt_atoms2
+    tgt_atoms2 = None
+    if args.store is not None:
+        # read the ligand field(s) of the requested site(s) straight from the binary fragment store
+        store = FragmentStore.load(args.store)
+        tgt_atoms, tgt_species = store.get_site_atoms(args.site)
+        tgt_atoms = [tgt_atoms]
+        if args.site2 is not None:
+            tgt_atoms2, tgt_species2 = store.get_site_atoms(args.site2)
+            tgt_atoms2 = [tgt_atoms2]
     else:
-        return population, tgt_atoms, tgt_species
+        tgt_atoms, _, _, tgt_species = read_xyz(args.tgt)
+        if args.tgt2 is not None:
+            tgt_atoms2, _, _, tgt_species2 = read_xyz(args.tgt2)
+    if tgt_atoms2 is not None:
+        tgt_species = list(set().union(tgt_species, tgt_species2)) # creates a single tgt_species list
+    return population, tgt_atoms, tgt_species, tgt_atoms2
 
 
 def main(args):
@@ -208,36 +422,116 @@ def main(args):
     co.average_size = args.tgt_size  # read what this does
     co.size_stdev = args.size_stdev
 
-    if args. tgt2 is not None:
-        population, tgt_atoms, tgt_species, tgt_atoms2 = initialise_system(args)
-    else:
-        population, tgt_atoms, tgt_species = initialise_system(args)
+    population, tgt_atoms, tgt_species, tgt_atoms2 = initialise_system(args)
     if mpi_rank==0:
         print('\nInitial Population Size: {}'.format(len(population)))
         print('No. of generations: {}'.format(args.n_gens))
         print('Mutation rate: {}'.format(args.mut_rate))
         print('')
 
+    # fix the SOAP feature space for the whole run, so that descriptors can be reused between generations
+    species = None
+    if args.fixed_species:
+        species = species_alphabet(tgt_species, population)
+        if mpi_rank==0:
+            print('Fixed species list: {}'.format(species))
+
+    # target ligand field descriptors, computed once per SOAP feature space
+    target = TargetSOAP(tgt_atoms, tgt_atoms2, path=args.tgt_soap_file, readonly=(mpi_rank!=0))
+
+    # cache of conformers, SOAP descriptors and fitnesses, keyed to the scoring settings - each rank keeps its own
+    cache = None
+    if args.cache_size > 0:
+        cache = MolCache(max_size=args.cache_size, path=args.cache_file, key=cache_key(args.rcut, args.sigma, args.kernel, target),
+                         max_soap=args.soap_cache_size)
+
+    # stage timings of every rank, collected by rank 0 at the end of each generation
+    timer = StageTimer(mpi_rank)
+
+    # every rank scores SMILES it is sent with the same settings - rank 0 has already looked its SMILES up in its cache
+    # (see pop_fitness), so only the other ranks count their lookups towards the hit ratio
+    score_batch = partial(score_smiles, rcut=args.rcut, sigma=args.sigma, kernel=args.kernel, tgt_atoms=tgt_atoms,
+                          tgt_species=tgt_species, tgt_atoms2=tgt_atoms2, cache=cache,
+                          target=target, species=species, n_procs=1,
+                          n_confs=args.n_confs, n_threads=args.n_procs, n_jobs=args.n_procs, timings=timer,
+                          count_lookups=(mpi_rank!=0),
+                          verbose=(mpi_rank==0 and args.schedule=='static' and args.mode=='generational'))
+
+    # only rank 0 reads the checkpoint, the other ranks just need to know where the run picks up
     max_score = [-999, '']
-    f = open('champions.dat', 'w')
-
-    for generation in range(args.n_gens):
+    fitness, state = None, None
+    if mpi_rank==0 and args.resume and os.path.exists(args.checkpoint):
+        state = load_checkpoint(args.checkpoint, cache)
+        population, fitness, max_score = state['population'], state['fitness'], state['max_score']
+        print('Resuming from generation {} of checkpoint {}'.format(state['generation'], args.checkpoint))
+    start_gen = mpi_comm.bcast(state['generation'] + 1 if state is not None else 0, root=0)
+    f = open('champions.dat', 'a' if start_gen > 0 else 'w')
+    log = None
+    if mpi_rank==0 and args.timing_log is not None:
+        log = TimingLog(args.timing_log, append=start_gen > 0)
+
+    def log_timings(generation):
+        rows = mpi_comm.gather(timer.record(generation, cache), root=0)
+        if log is not None:
+            log.write(rows)
+
+    if args.mode == 'steady':
+        # score the initial population as generation 0, then evolve it one batch of children at a time
+        if start_gen == 0:
+            if mpi_rank==0:
+                print('\nInitial population, size: {}'.format(len(population)))
+                print('Calculating fitness...')
+            fitness, max_score = pop_fitness(mpi_comm, mpi_rank, mpi_size, population, score_batch, max_score, cache=cache,
+                                             schedule=args.schedule, batch_size=args.batch_size, raw=True, timings=timer)
+            if mpi_rank==0:
+                f.write(max_score[1] + '\t' + str(max_score[0]) + '\n')
+                if args.checkpoint is not None:
+                    save_checkpoint(args.checkpoint, 0, population, fitness, max_score, cache=cache, n_done=0)
+            if args.timing_log is not None:
+                log_timings(0)
         if mpi_rank==0:
-            print('\nGeneration #{}, population size: {}'.format(generation, len(population)))
-            print('Calculating fitness...')
-        if args.tgt2 is not None:
-            fitness, max_score = pop_fitness(mpi_comm, mpi_rank, mpi_size,population, args.rcut, args.sigma, args.kernel, tgt_atoms, tgt_species, tgt_atoms2, max_score)
+            max_score = steady_state(mpi_comm, mpi_size, population, fitness, (args.n_gens - 1)*len(population), args.mut_rate,
+                                     score_batch, max_score, f, batch_size=args.batch_size,
+                                     tournament_size=args.tournament_size, cache=cache,
+                                     n_done=state['n_done'] if state is not None else 0, checkpoint=args.checkpoint,
+                                     checkpoint_every=args.checkpoint_every, timings=timer,
+                                     selection=args.selection)
         else:
-            fitness, max_score = pop_fitness(mpi_comm, mpi_rank, mpi_size, population, args.rcut, args.sigma, args.kernel, tgt_atoms, tgt_species, None,  max_score)
+            work_loop(mpi_comm, score_batch)
+        if args.timing_log is not None:
+            log_timings(-1) # there are no generation barriers to collect at, so log totals for the whole run
+        return
+
+    if start_gen > 0 and start_gen < args.n_gens:
+        # the checkpointed population has already been scored - carry on from breeding its children
+        with timer.stage('reproduce'):
+            population = reproduce(mpi_comm, mpi_rank, mpi_size, population, fitness, args.mut_rate, args.selection,
+                                   args.tournament_size)
+
+    for generation in range(start_gen, args.n_gens):
         if mpi_rank==0:
-            population = reproduce(population, fitness, args.mut_rate)
-        population = mpi_comm.bcast(population, root=0)
+            print('\nGeneration #{}, population size: {}'.format(generation, len(population)))
+            print('Calculating fitness...')
+        fitness, max_score = pop_fitness(mpi_comm, mpi_rank, mpi_size, population, score_batch, max_score, cache=cache,
+                                         schedule=args.schedule, batch_size=args.batch_size, timings=timer)
+        if cache is not None and args.cache_file is not None and mpi_rank==0:
+            cache.save() # rank 0 holds the fitnesses from every rank, as well as its own conformers/SOAP
 
         # Think you might want to print out the best-k individuals from each generation - wil leave that to you
         if mpi_rank==0:
             print('Champion fitness = {}, smiles = {}'.format(max_score[0], max_score[1]))
             f.write(max_score[1] + '\t' + str(max_score[0]) + '\n')
             f.flush()
+            if args.checkpoint is not None and (generation + 1) % args.checkpoint_every == 0:
+                save_checkpoint(args.checkpoint, generation, population, fitness, max_score, cache=cache)
+
+        # every rank makes a share of the children, but only rank 0 keeps the population - the other ranks are sent the
+        # SMILES they have to score
+        with timer.stage('reproduce'):
+            population = reproduce(mpi_comm, mpi_rank, mpi_size, population, fitness, args.mut_rate, args.selection,
+                                   args.tournament_size)
+        if args.timing_log is not None:
+            log_timings(generation)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -247,6 +541,13 @@ if __name__ == "__main__":
                         help='path to .xyz file containing binding fragments coordinates.')
     parser.add_argument('-tgt2', type=str, default=None, 
                         help="path to .xyz file of fragments of second site")
+    parser.add_argument('-store', type=str, default=None,
+                        help='path to .npz fragment store (data/frag_analysis/xyz/fragments.npz) to read the target '
+                             'ligand field from instead of -tgt/-tgt2.')
+    parser.add_argument('-site', type=int, default=None,
+                        help='site number of the target fragments in -store, all fragments if not given.')
+    parser.add_argument('-site2', type=int, default=None,
+                        help='site number of the second site fragments in -store.')
     parser.add_argument('-mut_rate', type=float, default=0.01,
                         help='Probability of mutations.')
     parser.add_argument('-n_gens', type=int, default=50,
@@ -261,6 +562,58 @@ if __name__ == "__main__":
                         help='sigma for SOAP feature generation.')
     parser.add_argument('-kernel', type=str, default='average',
                         help='SOAP kernel used for similarity score - either "average" or "rematch"')
+    parser.add_argument('-n_procs', type=int, default=1,
+                        help='Number of processes used for SOAP descriptors on each MPI rank. Conformers are embedded '
+                             'serially on each rank (forking a pool inside an MPI rank is unsafe), using n_procs '
+                             'threads when n_confs > 1 - use more ranks to embed more molecules at once.')
+    parser.add_argument('-n_confs', type=int, default=1,
+                        help='Number of conformers embedded per molecule (first one is kept).')
+    parser.add_argument('-cache_size', type=int, default=10000,
+                        help='Maximum number of molecules (conformers and fitnesses, a few kB each) cached between '
+                             'generations on each rank, 0 to disable.')
+    parser.add_argument('-soap_cache_size', type=int, default=200,
+                        help='Maximum number of cached molecules that also keep their SOAP descriptors (around 0.5 MB '
+                             'each) on each rank - only used with -fixed_species.')
+    parser.add_argument('-cache_file', type=str, default=None,
+                        help='.pkl file to persist the molecule cache to (and resume it from, if it exists) - written by rank 0.')
+    parser.add_argument('-fixed_species', action='store_true',
+                        help='Use one species list (target + mutation alphabet + initial population) for SOAP in every '
+                             'generation, instead of the species of each generation - lets SOAP descriptors be cached.')
+    parser.add_argument('-tgt_soap_file', type=str, default=None,
+                        help='.pkl file to persist the target SOAP descriptors to (and load them from, if it exists and '
+                             'matches the target coordinates) - written by rank 0.')
+    parser.add_argument('-mode', type=str, default='generational',
+                        help='"generational" GA, or "steady" state - rank 0 keeps the population as an archive and '
+                             'inserts children by tournament replacement as workers finish scoring them, with the same '
+                             'number of evaluations as n_gens generations.')
+    parser.add_argument('-tournament_size', type=int, default=4,
+                        help='Number of archive members a child competes against in -mode steady, and of population '
+                             'members in each tournament with -selection tournament.')
+    parser.add_argument('-selection', type=str, default='roulette',
+                        help='How parents are chosen for the mating pool - "roulette" (probability proportional to '
+                             'fitness), "tournament" (fittest of -tournament_size) or "rank" (probability proportional '
+                             'to fitness rank).')
+    parser.add_argument('-schedule', type=str, default='static',
+                        help='How molecules are shared between MPI ranks - "static" (equal chunks) or "dynamic" '
+                             '(rank 0 hands out batches on demand, better when embedding times vary a lot).')
+    parser.add_argument('-batch_size', type=int, default=8,
+                        help='Number of molecules per batch with -schedule dynamic, or children per batch with -mode steady.')
+    parser.add_argument('-checkpoint', type=str, default=None,
+                        help='.pkl file rank 0 checkpoints the scored population (or steady-state archive), RNG states '
+                             'and cached conformers and fitnesses (unless -cache_file is given) to.')
+    parser.add_argument('-checkpoint_every', type=int, default=1,
+                        help='Number of generations (or reports, with -mode steady) between checkpoints.')
+    parser.add_argument('-resume', action='store_true',
+                        help='Restart from -checkpoint if it exists, without rescoring the checkpointed population '
+                             '(champions.dat is appended to).')
+    parser.add_argument('-timing_log', type=str, default=None,
+                        help='.csv (or .jsonl) file rank 0 logs the embed/SOAP/kernel/gather/reproduce times, embedding '
+                             'failures, molecules/s and cache hit ratio of every rank and generation to (-mode steady '
+                             'logs the scored initial population as generation 0, then totals for the run as -1).')
     args = parser.parse_args()
+    if args.resume and args.checkpoint is None:
+        parser.error('-resume needs -checkpoint')
+    if args.selection not in selection_schemes:
+        parser.error('-selection should be one of {}'.format(selection_schemes))
 
     main(args)
@@ -1,25 +1,26 @@
 """Runs graph-based genetic algorithm to optimize the SOAP similarity between initial population and target data"""
 
+import os
 import time
-import random
 import argparse
+import multiprocessing as mp
 
 import numpy as np
-from ase import Atoms
 import pandas as pd
 from rdkit import Chem
-from rdkit.Chem import AllChem
-from dscribe.descriptors import SOAP
-from dscribe.kernels import REMatchKernel, AverageKernel
-from sklearn.preprocessing import normalize
 
-from helper import read_xyz, split_by_lengths
+from helper import read_xyz, FragmentStore
 # The following two are written by Jensen
 import crossover as co
-import mutate as mu
+from conformers import close_pool
+from soap_fitness import score_population, dedup_population, species_alphabet, cache_key, TargetSOAP
+from mol_cache import MolCache
+from checkpoint import save_checkpoint, load_checkpoint
+from timings import StageTimer, TimingLog
+from reproduction import make_children, pool_children, init_worker, select_parents, selection_schemes
 
 
-def reproduce(population, fitness, mutation_rate):
+def reproduce(population, fitness, mutation_rate, pool=None, n_tasks=1, selection='roulette', tournament_size=4):
     """
     Generates next generation of population by probabilistically choosing mating pool based on fitness, then
     probabilistically reproducing molecules in the mating pool and randomly mutating the children
@@ -27,116 +28,58 @@ def reproduce(population, fitness, mutation_rate):
     :param population: list of RDKit molecules
     :param fitness: probability distribution of same length as population, returned by pop_fitness
     :param mutation_rate: hyperparameter determining the likelihood of mutations occuring
+    :param pool: optional multiprocessing pool (started with reproduction.init_worker) the crossovers and mutations are
+     split over, as n_tasks tasks with their own seeds - see reproduction.pool_children
+    :param selection, tournament_size: how the mating pool is chosen, see reproduction.select_parents
 
     :return: new_population
     """
-    mating_pool = []
-    for i in range(len(population)):
-        mating_pool.append(np.random.choice(population, p=fitness))
-
-    new_population = []
-    for n in range(len(population)):
-        parent_A = random.choice(mating_pool)
-        parent_B = random.choice(mating_pool)
-        # print Chem.MolToSmiles(parent_A),Chem.MolToSmiles(parent_B)
-        new_child = co.crossover(parent_A, parent_B)
-        # print new_child
-        if new_child is not None:
-            new_child = mu.mutate(new_child, mutation_rate)
-            # print("after mutation",new_child)
-            if new_child is not None:
-                new_population.append(new_child)
-
-    return new_population
-
-
-def pop_fitness(population, rcut, sigma, kernel, tgt_atoms, tgt_species, tgt_atoms2=None, max_score=[-9999,'']):
+    mating_pool = [population[i] for i in select_parents(fitness, len(population), selection, tournament_size)]
+
+    if pool is not None:
+        return pool_children(pool, mating_pool, len(population), mutation_rate, n_tasks)
+    return make_children(mating_pool, len(population), mutation_rate)
+
+
+def pop_fitness(population, rcut, sigma, kernel, tgt_atoms, tgt_species, tgt_atoms2=None, max_score=[-9999,''],
+                cache=None, target=None, species=None, n_procs=1, embed_timeout=None, n_confs=1, timings=None):
     """
     Calculates the fitness (ie SOAP similarity score) of the population by generating conformers for each of the
     population molecules, then evaluating their SOAP descriptors and calculating its similarity score with the SOAP
-    descriptor of the binding ligand 'field'
+    descriptor of the binding ligand 'field' - see soap_fitness.score_population
 
-    Conformer generation and similarity calculation are the computational bottlenecks  - might be worth splitting the
-    task up with MPI. see return_borders.py in helper.py if you want to do that - make sure you only run the
-    reproduction on the master node (since there is randomness), then broadcast to the other nodes
+    Conformer generation and similarity calculation are the computational bottlenecks - conformers are generated by
+    conformers.embed_population, which can use a process pool over the cores of a single node (see GA-soap-mpi.py for
+    splitting the task up with MPI)
 
     :param population: list of RDKit molecule objects
     :param tgt_atoms: list of ASE atom objects of the target ligand field - from read_xyz, second is optional if separate sites
     :param tgt_species: list of the atomic species present in the target ligand field - from read_xyz
     :param rcut, sigma: SOAP parameters
     :param max_score: Maximum SOAP similarity found so far
+    :param target: optional soap_fitness.TargetSOAP holding the target descriptors across generations
+    :param species: optional fixed species list for SOAP generation, see soap_fitness.species_alphabet
+    :param cache: optional MolCache of conformers, SOAP descriptors and fitnesses from previous generations
+    :param n_procs, embed_timeout, n_confs: conformer generation settings, see conformers.embed_population - n_procs
+     is also used for the SOAP descriptors
+    :param timings: optional timings.StageTimer recording the stage times of the generation
 
     :return: fitness, max_score, fit_mean, fit_std
     """
-    t0 = time.time()
-
-    # loop over RDKit mols and turn them into lists of ASE atom objects for dscribe SOAP atomic feature generation
-    population_ase = []
-    num_list = []
-    species = ['C']
-    bad_mols = []
-    for m in population:
-        m = Chem.AddHs(m)
-        conf_result = AllChem.EmbedMolecule(m, maxAttempts=1000)
-        if conf_result != 0:
-            bad_mols.append(m)
-            continue
-        m = Chem.RemoveHs(m)
-        num_list.append(len(m.GetAtoms()))
-        for i, atom in enumerate(m.GetAtoms()): # this is actually wrong, should have an Atoms object for each mol...
-            symbol = atom.GetSymbol()
-            conf = m.GetConformer()
-            population_ase.append(Atoms(symbol, [conf.GetPositions()[i]]))
-            if symbol not in species:  # find unique atomic species for SOAP generation
-                species.append(symbol)
-    if bad_mols != []:
-        for bm in bad_mols:
-            bm = Chem.RemoveHs(bm)
-            try:
-                population.remove(bm) # filter out molecules which have no conformers
-            except:
-                continue
-    # Check that we also include the atom types present in the ligand targets
-    for atom in tgt_species:
-        if atom not in species:
-            species.append(atom)
-    t1 = time.time()
-    print('Time taken to generate conformers: {}'.format(t1-t0))
-
-    # Generate SOAP descriptors using dscribe
-    soap_generator = SOAP(species=species, periodic=False, rcut=rcut, nmax=8, lmax=6, sigma=sigma, sparse=True)
-    soap = soap_generator.create(population_ase)
-    tgt_soap = soap_generator.create(tgt_atoms)
-    if tgt_atoms2 is not None:
-        tgt_soap2 = [normalize(soap_generator.create(tgt_atoms2), copy=False)]
-
-    # normalize SOAP atom descriptors and group by molecule
-    soap = normalize(soap, copy=False)
-    tgt_soap = [normalize(tgt_soap, copy=False)]
-    soap = split_by_lengths(soap, num_list)
+    # score each unique molecule once, then scatter the fitnesses back to all copies
+    unique_pop, unique_smiles, inverse = dedup_population(population)
+    print('Unique molecules: {}/{} (dedup ratio {:.3f})'.format(len(unique_pop), len(population),
+                                                                1 - len(unique_pop)/len(population)))
+    fitness = score_population(unique_pop, rcut, sigma, kernel, tgt_atoms, tgt_species, tgt_atoms2, cache=cache,
+                               n_procs=n_procs, embed_timeout=embed_timeout, n_confs=n_confs, smiles=unique_smiles, target=target, species=species, n_jobs=n_procs,
+                               timings=timings)
+    fitness = fitness[inverse]
+    if cache is not None:
+        hit_ratio = cache.hit_ratio()
+        print('Cache size: {}, hit ratio: {:.3f}'.format(len(cache), hit_ratio))
+        if timings is not None:
+            timings.cache_hit_ratio = hit_ratio
 
-    t2 = time.time()
-    print('Time taken to generate SOAP descriptors: {}'.format(t2-t1))
-
-    # TODO make REMatch kernel args as input args
-    if kernel == 'rematch':
-        soap_similarity = REMatchKernel(metric="polynomial", degree=3, gamma=1, coef0=0, alpha=0.1, threshold=1e-3, normalize_kernel=True)
-    elif kernel == 'average':
-        soap_similarity = AverageKernel(metric="polynomial", degree=3, gamma=1, coef0=0, normalize_kernel=True)
-    if tgt_atoms2 is not None:
-        fitness1 = soap_similarity.create(soap, tgt_soap)
-        fitness1.flatten()
-        fitness2 = soap_similarity.create(soap, tgt_soap2)
-        fitness2.flatten()
-        # calculate fitness score as product of the two fitnesses
-        fitness = np.multiply(fitness1, fitness2)
-        fitness = np.array([f[0] for f in fitness])
-    else:
-        fitness = soap_similarity.create(soap, tgt_soap)
-        fitness = fitness.flatten()
-
-    t3 = time.time()
-    print('Time taken to calculate fitness: {}'.format(t3-t2))
     # update max_score, include new champion
     if np.amax(fitness) > max_score[0]:
         max_score = [np.amax(fitness), Chem.MolToSmiles(population[np.argmax(fitness)])]
@@ -157,23 +100,33 @@ def initialise_system(args):
     """
     Reads in a .csv file and generates a population of RDKit molecules, as well as reading in target ligand coordinates
 
-    :param args: system arguments parsed into main - should contain args.csv, args.tgt (and args.tgt2)
+    :param args: system arguments parsed into main - should contain args.csv, args.tgt (and args.tgt2), or args.store
+     and args.site (and args.site2)
 
-    :return: population, tgt_atoms, tg_species
-     or population, tgt_atoms, tgt_species, tgt_atoms2, tgt_species2
+    :return: population, tgt_atoms, tgt_species, tgt_atoms2 - tgt_atoms2 is None without a second site, otherwise
+     tgt_species covers both sites
     """
     population = []
     csv = pd.read_csv(args.csv, header=0)
     for i, row in csv.iterrows():
         population.append(Chem.MolFromSmiles(row['SMILES']))
 
-    tgt_atoms, _, _, tgt_species = read_xyz(args.tgt)
-    if args.tgt2 is not None:
-        tgt_atoms2, _, _, tgt_species2 = read_xyz(args.tgt2)
-        tgt_species = list(set().union(tgt_species, tgt_species2)) # creates a single tgt_species list
-        return population, tgt_atoms, tgt_species, tgt_atoms2
+    tgt_atoms2 = None
+    if args.store is not None:
+        # read the ligand field(s) of the requested site(s) straight from the binary fragment store
+        store = FragmentStore.load(args.store)
+        tgt_atoms, tgt_species = store.get_site_atoms(args.site)
+        tgt_atoms = [tgt_atoms]
+        if args.site2 is not None:
+            tgt_atoms2, tgt_species2 = store.get_site_atoms(args.site2)
+            tgt_atoms2 = [tgt_atoms2]
     else:
-        return population, tgt_atoms, tgt_species
+        tgt_atoms, _, _, tgt_species = read_xyz(args.tgt)
+        if args.tgt2 is not None:
+            tgt_atoms2, _, _, tgt_species2 = read_xyz(args.tgt2)
+    if tgt_atoms2 is not None:
+        tgt_species = list(set().union(tgt_species, tgt_species2)) # creates a single tgt_species list
+    return population, tgt_atoms, tgt_species, tgt_atoms2
 
 
 def main(args):
@@ -190,34 +143,78 @@ def main(args):
     co.average_size = args.tgt_size  # read what this does
     co.size_stdev = args.size_stdev
 
-    if args. tgt2 is not None:
-        population, tgt_atoms, tgt_species, tgt_atoms2 = initialise_system(args)
-    else:
-        population, tgt_atoms, tgt_species = initialise_system(args)
+    population, tgt_atoms, tgt_species, tgt_atoms2 = initialise_system(args)
 
     print('\nInitial Population Size: {}'.format(len(population)))
     print('No. of generations: {}'.format(args.n_gens))
     print('Mutation rate: {}'.format(args.mut_rate))
     print('')
 
-    max_score = [-999, '']
-    f = open('champions.dat', 'w')
+    # fix the SOAP feature space for the whole run, so that descriptors can be reused between generations
+    species = None
+    if args.fixed_species:
+        species = species_alphabet(tgt_species, population)
+        print('Fixed species list: {}'.format(species))
+
+    # target ligand field descriptors, computed once per SOAP feature space
+    target = TargetSOAP(tgt_atoms, tgt_atoms2, path=args.tgt_soap_file)
+
+    # cache of conformers, SOAP descriptors and fitnesses, keyed to the scoring settings
+    cache = None
+    if args.cache_size > 0:
+        cache = MolCache(max_size=args.cache_size, path=args.cache_file, key=cache_key(args.rcut, args.sigma, args.kernel, target),
+                         max_soap=args.soap_cache_size)
 
-    for generation in range(args.n_gens):
+    max_score = [-999, '']
+    start_gen = 0
+    resume = args.resume and os.path.exists(args.checkpoint)
+    timer = StageTimer()
+    # worker processes for crossover and mutation, started once for the whole run
+    pool = None
+    if args.n_procs > 1:
+        pool = mp.Pool(args.n_procs, initializer=init_worker, initargs=(co.average_size, co.size_stdev))
+    log = TimingLog(args.timing_log, append=resume) if args.timing_log is not None else None
+    if resume:
+        # the checkpointed population has already been scored - carry on from breeding its children
+        state = load_checkpoint(args.checkpoint, cache)
+        population, max_score = state['population'], state['max_score']
+        start_gen = state['generation'] + 1
+        print('Resuming from generation {} of checkpoint {}'.format(state['generation'], args.checkpoint))
+        if start_gen < args.n_gens:
+            print('Producing next generation...')
+            with timer.stage('reproduce'):
+                population = reproduce(population, state['fitness'], args.mut_rate, pool, args.n_procs,
+                                       args.selection, args.tournament_size)
+    f = open('champions.dat', 'a' if resume else 'w')
+
+    for generation in range(start_gen, args.n_gens):
         print('\nGeneration #{}, population size: {}'.format(generation, len(population)))
         print('Calculating fitness...')
-        if args.tgt2 is not None:
-            fitness, max_score = pop_fitness(population, args.rcut, args.sigma, args.kernel, tgt_atoms, tgt_species, tgt_atoms2, max_score)
-        else:
-            fitness, max_score = pop_fitness(population, args.rcut, args.sigma, args.kernel, tgt_atoms, tgt_species, None,  max_score)
-        print('Producing next generation...')
-        population = reproduce(population, fitness, args.mut_rate)
+        fitness, max_score = pop_fitness(population, args.rcut, args.sigma, args.kernel, tgt_atoms, tgt_species, tgt_atoms2, max_score, cache=cache, target=target, species=species,
+                                         n_procs=args.n_procs, embed_timeout=args.embed_timeout, n_confs=args.n_confs,
+                                         timings=timer)
+        if cache is not None and args.cache_file is not None:
+            cache.save()
 
         # Think you might want to print out the best-k individuals from each generation - wil leave that to you
         print('Champion fitness = {}, smiles = {}'.format(max_score[0], max_score[1]))
         f.write(max_score[1] + '\t' + str(max_score[0]) + '\n')
         f.flush()
 
+        if args.checkpoint is not None and (generation + 1) % args.checkpoint_every == 0:
+            save_checkpoint(args.checkpoint, generation, population, fitness, max_score, cache=cache)
+        print('Producing next generation...')
+        with timer.stage('reproduce'):
+            population = reproduce(population, fitness, args.mut_rate, pool, args.n_procs, args.selection,
+                                   args.tournament_size)
+        if log is not None:
+            log.write([timer.record(generation, cache)])
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    close_pool()
+
     t1 = time.time()
     print('\nTime taken: {}'.format(t1 - t0))
 
@@ -230,6 +227,13 @@ if __name__ == "__main__":
                         help='path to .xyz file containing binding fragments coordinates.')
     parser.add_argument('-tgt2', type=str, default=None, 
                         help="path to .xyz file of fragments of second site")
+    parser.add_argument('-store', type=str, default=None,
+                        help='path to .npz fragment store (data/frag_analysis/xyz/fragments.npz) to read the target '
+                             'ligand field from instead of -tgt/-tgt2.')
+    parser.add_argument('-site', type=int, default=None,
+                        help='site number of the target fragments in -store, all fragments if not given.')
+    parser.add_argument('-site2', type=int, default=None,
+                        help='site number of the second site fragments in -store.')
     parser.add_argument('-mut_rate', type=float, default=0.01,
                         help='Probability of mutations.')
     parser.add_argument('-n_gens', type=int, default=50,
@@ -244,6 +248,48 @@ if __name__ == "__main__":
                         help='sigma for SOAP feature generation.')
     parser.add_argument('-kernel', type=str, default='average',
                         help='SOAP kernel used for similarity score - either "average" or "rematch"')
+    parser.add_argument('-n_procs', type=int, default=1,
+                        help='Number of processes used for conformer generation, SOAP descriptors and reproduction.')
+    parser.add_argument('-embed_timeout', type=float, default=None,
+                        help='Time limit (in seconds) for embedding a single molecule when n_procs > 1, slower molecules get fitness 0.')
+    parser.add_argument('-n_confs', type=int, default=1,
+                        help='Number of conformers embedded per molecule (first one is kept). If > 1 and n_procs == 1, '
+                             'uses the multi-threaded RDKit EmbedMultipleConfs.')
+    parser.add_argument('-cache_size', type=int, default=10000,
+                        help='Maximum number of molecules (conformers and fitnesses, a few kB each) cached between '
+                             'generations, 0 to disable.')
+    parser.add_argument('-soap_cache_size', type=int, default=200,
+                        help='Maximum number of cached molecules that also keep their SOAP descriptors (around 0.5 MB '
+                             'each) - only used with -fixed_species.')
+    parser.add_argument('-cache_file', type=str, default=None,
+                        help='.pkl file to persist the molecule cache to (and resume it from, if it exists).')
+    parser.add_argument('-fixed_species', action='store_true',
+                        help='Use one species list (target + mutation alphabet + initial population) for SOAP in every '
+                             'generation, instead of the species of each generation - lets SOAP descriptors be cached.')
+    parser.add_argument('-tgt_soap_file', type=str, default=None,
+                        help='.pkl file to persist the target SOAP descriptors to (and load them from, if it exists and '
+                             'matches the target coordinates).')
+    parser.add_argument('-selection', type=str, default='roulette',
+                        help='How parents are chosen for the mating pool - "roulette" (probability proportional to '
+                             'fitness), "tournament" (fittest of -tournament_size) or "rank" (probability proportional '
+                             'to fitness rank).')
+    parser.add_argument('-tournament_size', type=int, default=4,
+                        help='Number of population members in each tournament with -selection tournament.')
+    parser.add_argument('-checkpoint', type=str, default=None,
+                        help='.pkl file to checkpoint the scored population, RNG states and cached conformers and fitnesses '
+                             '(unless -cache_file is given) to.')
+    parser.add_argument('-checkpoint_every', type=int, default=1,
+                        help='Number of generations between checkpoints.')
+    parser.add_argument('-resume', action='store_true',
+                        help='Restart from -checkpoint if it exists, without rescoring the checkpointed population '
+                             '(champions.dat is appended to).')
+    parser.add_argument('-timing_log', type=str, default=None,
+                        help='.csv (or .jsonl) file to log the embed/SOAP/kernel/reproduce times, embedding failures, '
+                             'molecules/s and cache hit ratio of every generation to.')
     args = parser.parse_args()
+    if args.resume and args.checkpoint is None:
+        parser.error('-resume needs -checkpoint')
+    if args.selection not in selection_schemes:
+        parser.error('-selection should be one of {}'.format(selection_schemes))
 
     main(args)
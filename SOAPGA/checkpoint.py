@@ -0,0 +1,57 @@
+"""Checkpoint/restart of GA runs - the scored population, RNG states, generation counter and molecule cache"""
+
+import os
+import random
+import pickle
+
+import numpy as np
+from rdkit import Chem
+
+
+def save_checkpoint(path, generation, population, fitness, max_score, cache=None, **extra):
+    """
+    Writes a checkpoint of a population that has just been scored. The Python and NumPy RNG states are stored too, so
+    a restarted run breeds exactly the same next generation as the original one would have. The file is written to a
+    temporary name and moved into place, so a job killed mid-write leaves the previous checkpoint intact.
+
+    :param path: checkpoint .pkl file, overwritten with the latest checkpoint
+    :param generation: generation counter of the scored population
+    :param population: list of RDKit molecules, stored both as SMILES and as RDKit binary molecules - molecules from
+     crossover/mutation are kekulized and their atom order matters to crossover, which a SMILES round trip changes
+    :param fitness: fitness of the population, as passed on to reproduce
+    :param max_score: Maximum SOAP similarity found so far
+    :param cache: optional MolCache - its conformers and fitnesses are stored in the checkpoint unless it is persisted
+     to its own file (cache.path). The SOAP matrices are left out, they would make every checkpoint several GB
+    :param extra: any other picklable state, eg the evaluation counter of steady-state runs
+    """
+    state = {'generation': generation,
+             'smiles': [Chem.MolToSmiles(m) for m in population],
+             'mols': [m.ToBinary() for m in population],
+             'fitness': np.asarray(fitness),
+             'max_score': list(max_score),
+             'random_state': random.getstate(),
+             'numpy_state': np.random.get_state(),
+             'cache': cache.state(fields=('conformer', 'fitness')) if cache is not None and cache.path is None else None}
+    state.update(extra)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def load_checkpoint(path, cache=None):
+    """
+    Reads a checkpoint written by save_checkpoint, restoring the RNG states and (if stored) the cache contents
+
+    :param path: checkpoint .pkl file
+    :param cache: optional MolCache to restore the stored cache into
+
+    :return: dict of the saved state, with the molecules rebuilt under 'population'
+    """
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    random.setstate(state['random_state'])
+    np.random.set_state(state['numpy_state'])
+    if cache is not None and state['cache'] is not None:
+        cache.restore(state['cache'])
+    state['population'] = [Chem.Mol(binary) for binary in state['mols']]
+    return state
@@ -0,0 +1,126 @@
+"""Conformer generation stage for the SOAP GA - embeds a population of RDKit molecules serially or in parallel"""
+
+import time
+import multiprocessing as mp
+from queue import Empty
+
+from rdkit import Chem
+from rdkit.Chem import AllChem
+
+
+def embed_molecule(mol, max_attempts=1000, n_confs=1, n_threads=1):
+    """
+    Generates a 3D conformer for a single molecule
+
+    :param mol: RDKit molecule
+    :param max_attempts: maximum number of embedding attempts
+    :param n_confs, n_threads: if n_confs > 1, embeds n_confs conformers with RDKit's multi-threaded
+     EmbedMultipleConfs (using n_threads threads) and keeps the first - embedding then only fails if all of them fail
+
+    :return: (symbols, positions) of the heavy atoms, or None if embedding failed
+    """
+    m = Chem.AddHs(mol)
+    if n_confs > 1:
+        conf_ids = list(AllChem.EmbedMultipleConfs(m, numConfs=n_confs, maxAttempts=max_attempts, numThreads=n_threads))
+        if len(conf_ids) == 0:
+            return None
+        conf_id = conf_ids[0]
+    else:
+        conf_id = AllChem.EmbedMolecule(m, maxAttempts=max_attempts)
+        if conf_id != 0:
+            return None
+    m = Chem.RemoveHs(m)
+    return [atom.GetSymbol() for atom in m.GetAtoms()], m.GetConformer(conf_id).GetPositions()
+
+
+# embedding pool of this process, started on first use and kept between calls - it is only replaced when the number
+# of workers changes or a timed-out molecule forces it to be torn down
+_pool = None
+_pool_size = 0
+_started_queue = None
+_n_calls = 0
+
+
+def _init_worker(started_queue):
+    global _started
+    _started = started_queue
+
+
+def _embed_task(call, ind, mol, max_attempts, n_confs):
+    _started.put((call, ind, time.time())) # lets the master time out molecules individually
+    return embed_molecule(mol, max_attempts, n_confs)
+
+
+def _get_pool(n_procs):
+    global _pool, _pool_size, _started_queue
+    if _pool is None or _pool_size != n_procs:
+        close_pool()
+        _started_queue = mp.Queue()
+        _pool = mp.Pool(n_procs, initializer=_init_worker, initargs=(_started_queue,))
+        _pool_size = n_procs
+    return _pool
+
+
+def close_pool(terminate=False):
+    """Shuts down the embedding pool of this process, if one was started"""
+    global _pool
+    if _pool is not None:
+        if terminate:
+            _pool.terminate()
+        else:
+            _pool.close()
+        _pool.join()
+        _pool = None
+
+
+def embed_population(population, n_procs=1, timeout=None, max_attempts=1000, n_confs=1, n_threads=0, poll_interval=0.05):
+    """
+    Generates conformers for a whole population. With n_procs > 1 the molecules are embedded in a multiprocessing pool
+    on the local node, which is started on the first call and reused by later ones; if timeout is set, any molecule
+    that takes longer than timeout seconds is counted as failed (the pool is torn down and the unfinished molecules
+    resubmitted to a fresh one) so that one pathological molecule can't stall a generation.
+
+    :param population: list of RDKit molecules
+    :param n_procs: number of worker processes (1 embeds serially in this process) - the pool forks, so keep this at 1
+     inside MPI ranks
+    :param timeout: per-molecule time limit in seconds, only enforced when n_procs > 1
+    :param max_attempts, n_confs: passed to embed_molecule
+    :param n_threads: threads used by EmbedMultipleConfs when n_procs == 1 and n_confs > 1 (0 uses all cores)
+
+    :return: list of (symbols, positions) or None for molecules that failed to embed, same order as population
+    """
+    if n_procs <= 1:
+        return [embed_molecule(m, max_attempts, n_confs, n_threads) for m in population]
+
+    global _n_calls
+    _n_calls += 1 # tags the start times, so that ones left in the queue by an earlier call are ignored
+    conformers = [None]*len(population)
+    pending = set(range(len(population)))
+    while pending:
+        pool = _get_pool(n_procs)
+        jobs = {i: pool.apply_async(_embed_task, (_n_calls, i, population[i], max_attempts, n_confs))
+                for i in sorted(pending)}
+        start_times = {}
+        timed_out = False
+        while jobs:
+            try:
+                while True:
+                    call, i, t_start = _started_queue.get_nowait()
+                    if call == _n_calls:
+                        start_times[i] = t_start
+            except Empty:
+                pass
+            for i in [i for i, job in jobs.items() if job.ready()]:
+                conformers[i] = jobs.pop(i).get()
+                pending.discard(i)
+            overdue = [i for i in jobs if timeout is not None and i in start_times and time.time() - start_times[i] > timeout]
+            if overdue:
+                for i in overdue: # leave these as failed embeddings
+                    pending.discard(i)
+                timed_out = True
+                break
+            if jobs:
+                time.sleep(poll_interval)
+        if timed_out:
+            close_pool(terminate=True)
+    return conformers
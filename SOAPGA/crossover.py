@@ -10,10 +10,35 @@ import numpy as np
 from rdkit import rdBase
 rdBase.DisableLog('rdApp.error')
 
+# SMARTS patterns and reactions are compiled once per process and shared by every call, rather than being parsed again
+# for each child (and each retry) - the parametrized ones from mutate.py are keyed by their SMARTS string
+_patterns = {}
+_reactions = {}
+
+def smarts(pattern):
+  """Query molecule for a SMARTS pattern, compiled on first use"""
+  if pattern not in _patterns:
+    _patterns[pattern] = Chem.MolFromSmarts(pattern)
+  return _patterns[pattern]
+
+def reaction(rxn_smarts):
+  """Chemical reaction for a reaction SMARTS, compiled on first use"""
+  if rxn_smarts not in _reactions:
+    _reactions[rxn_smarts] = AllChem.ReactionFromSmarts(rxn_smarts)
+  return _reactions[rxn_smarts]
+
+non_ring_single_bond = smarts('[*]-;!@[*]')
+ring_chain4 = smarts('[R]@[R]@[R]@[R]')
+ring_branch3 = smarts('[R]@[R;!D2]@[R]')
+ring_atom = smarts('[R]')
+ring_allene_pattern = smarts('[R]=[R]=[R]')
+small_ring_double_bond = smarts('[r3,r4]=[r3,r4]')
+
 def cut(mol):
-  if not mol.HasSubstructMatch(Chem.MolFromSmarts('[*]-;!@[*]')): 
+  matches = mol.GetSubstructMatches(non_ring_single_bond)
+  if not matches: 
   	return None
-  bis = random.choice(mol.GetSubstructMatches(Chem.MolFromSmarts('[*]-;!@[*]'))) #single bond not in ring
+  bis = random.choice(matches) #single bond not in ring
   #print bis,bis[0],bis[1]
   bs = [mol.GetBondBetweenAtoms(bis[0],bis[1]).GetIdx()]
 
@@ -26,14 +51,16 @@ def cut(mol):
 def cut_ring(mol):
   for i in range(10):
     if random.random() < 0.5:
-      if not mol.HasSubstructMatch(Chem.MolFromSmarts('[R]@[R]@[R]@[R]')): 
+      matches = mol.GetSubstructMatches(ring_chain4)
+      if not matches: 
       	return None
-      bis = random.choice(mol.GetSubstructMatches(Chem.MolFromSmarts('[R]@[R]@[R]@[R]')))
+      bis = random.choice(matches)
       bis = ((bis[0],bis[1]),(bis[2],bis[3]),)
     else:
-      if not mol.HasSubstructMatch(Chem.MolFromSmarts('[R]@[R;!D2]@[R]')): 
+      matches = mol.GetSubstructMatches(ring_branch3)
+      if not matches: 
       	return None
-      bis = random.choice(mol.GetSubstructMatches(Chem.MolFromSmarts('[R]@[R;!D2]@[R]')))
+      bis = random.choice(matches)
       bis = ((bis[0],bis[1]),(bis[1],bis[2]),)
     
     #print bis
@@ -49,16 +76,16 @@ def cut_ring(mol):
   return None
 
 def ring_OK(mol):
-  if not mol.HasSubstructMatch(Chem.MolFromSmarts('[R]')):
+  if not mol.HasSubstructMatch(ring_atom):
     return True
   
-  ring_allene = mol.HasSubstructMatch(Chem.MolFromSmarts('[R]=[R]=[R]'))
+  ring_allene = mol.HasSubstructMatch(ring_allene_pattern)
   
   cycle_list = mol.GetRingInfo().AtomRings() 
   max_cycle_length = max([ len(j) for j in cycle_list ])
   macro_cycle = max_cycle_length > 6
   
-  double_bond_in_small_ring = mol.HasSubstructMatch(Chem.MolFromSmarts('[r3,r4]=[r3,r4]'))
+  double_bond_in_small_ring = mol.HasSubstructMatch(small_ring_double_bond)
   
   return not ring_allene and not macro_cycle and not double_bond_in_small_ring
 
@@ -75,8 +102,7 @@ def mol_OK(mol):
 
 
 def crossover_ring(parent_A,parent_B):
-  ring_smarts = Chem.MolFromSmarts('[R]')
-  if not parent_A.HasSubstructMatch(ring_smarts) and not parent_B.HasSubstructMatch(ring_smarts):
+  if not parent_A.HasSubstructMatch(ring_atom) and not parent_B.HasSubstructMatch(ring_atom):
     return None
   
   rxn_smarts1 = ['[*:1]~[1*].[1*]~[*:2]>>[*:1]-[*:2]','[*:1]~[1*].[1*]~[*:2]>>[*:1]=[*:2]']
@@ -90,7 +116,7 @@ def crossover_ring(parent_A,parent_B):
     
     new_mol_trial = []
     for rs in rxn_smarts1:
-      rxn1 = AllChem.ReactionFromSmarts(rs)
+      rxn1 = reaction(rs)
       new_mol_trial = []
       for fa in fragments_A:
         for fb in fragments_B:
@@ -98,7 +124,7 @@ def crossover_ring(parent_A,parent_B):
 
     new_mols = []
     for rs in rxn_smarts2:
-      rxn2 = AllChem.ReactionFromSmarts(rs)
+      rxn2 = reaction(rs)
       for m in new_mol_trial:
         m = m[0]
         if mol_OK(m):
@@ -121,7 +147,7 @@ def crossover_non_ring(parent_A,parent_B):
     fragments_B = cut(parent_B)
     if fragments_A == None or fragments_B == None:
       return None
-    rxn = AllChem.ReactionFromSmarts('[*:1]-[1*].[1*]-[*:2]>>[*:1]-[*:2]')
+    rxn = reaction('[*:1]-[1*].[1*]-[*:2]>>[*:1]-[*:2]')
     new_mol_trial = []
     for fa in fragments_A:
       for fb in fragments_B:
@@ -0,0 +1,136 @@
+"""Size-bounded LRU cache of per-molecule GA results (conformer, SOAP matrix, fitness) keyed by canonical SMILES"""
+
+import os
+import pickle
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from rdkit import Chem
+
+
+def canonical_smiles(mol):
+    """
+    Canonical SMILES used as the cache key - molecules coming out of crossover/mutation are kekulized, so they are
+    round-tripped through SMILES to get the same (aromatic) form as their sanitized equivalents
+    """
+    smiles = Chem.MolToSmiles(mol)
+    m = Chem.MolFromSmiles(smiles)
+    return Chem.MolToSmiles(m) if m is not None else smiles
+
+
+def atoms_hash(atoms_list):
+    """Hash of the symbols and coordinates of a list of ASE Atoms objects, used to key cached scores to a target"""
+    h = hashlib.sha1()
+    for atoms in atoms_list:
+        h.update(' '.join(atoms.get_chemical_symbols()).encode())
+        h.update(np.ascontiguousarray(atoms.get_positions(), dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+class MolCache(object):
+    """
+    Least-recently-used cache from canonical SMILES to a dict of results for that molecule:
+     'conformer' - (symbols, positions) from conformers.embed_molecule
+     'soap'      - normalized per-atom SOAP matrix, valid for the feature space given by 'soap_key'
+     'fitness'   - raw (unnormalized) fitness
+
+    The SOAP matrices and fitnesses depend on the scoring settings (SOAP parameters, kernel and target), so the cache
+    carries a key for those settings - when a cache saved under a different key is loaded, only the conformers are kept.
+
+    A SOAP matrix takes around 0.5 MB, hundreds of times more than a conformer and fitness, so the number of molecules
+    holding one is bounded separately - the least recently used ones drop their SOAP matrix and keep the rest.
+    """
+    def __init__(self, max_size=10000, path=None, key=None, max_soap=200):
+        """
+        :param max_size: maximum number of molecules held, least recently used ones are evicted first
+        :param path: optional .pkl file the cache is loaded from (if it exists) and saved to
+        :param key: hashable description of the scoring settings
+        :param max_soap: maximum number of molecules whose SOAP matrix is held
+        """
+        self.max_size = max_size
+        self.max_soap = max_soap
+        self.path = path
+        self.key = key
+        self.entries = OrderedDict()
+        self.soap_order = OrderedDict() # molecules holding a SOAP matrix, least recently used first
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, smiles):
+        return smiles in self.entries
+
+    def get(self, smiles, field, count=True):
+        """Returns the cached field for a molecule, or None - counts towards the hit ratio if count=True"""
+        entry = self.entries.get(smiles)
+        if entry is None or field not in entry:
+            self.misses += count
+            return None
+        self.entries.move_to_end(smiles)
+        if field == 'soap':
+            self.soap_order.move_to_end(smiles)
+        self.hits += count
+        return entry[field]
+
+    def update(self, smiles, **fields):
+        entry = self.entries.setdefault(smiles, {})
+        entry.update(fields)
+        self.entries.move_to_end(smiles)
+        if 'soap' in fields:
+            self.soap_order[smiles] = None
+            self.soap_order.move_to_end(smiles)
+        self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.max_size:
+            smiles, _ = self.entries.popitem(last=False)
+            self.soap_order.pop(smiles, None)
+        while len(self.soap_order) > self.max_soap:
+            smiles, _ = self.soap_order.popitem(last=False)
+            self.entries[smiles].pop('soap', None)
+            self.entries[smiles].pop('soap_key', None)
+
+    def hit_ratio(self, reset=True):
+        """Fraction of lookups since the last reset that were hits"""
+        n_lookups = self.hits + self.misses
+        ratio = self.hits / n_lookups if n_lookups > 0 else 0.0
+        if reset:
+            self.hits, self.misses = 0, 0
+        return ratio
+
+    def state(self, fields=None):
+        """
+        Picklable contents of the cache, see restore
+
+        :param fields: only keep these fields of each molecule (eg leave out the large SOAP matrices)
+        """
+        entries = self.entries
+        if fields is not None:
+            entries = OrderedDict((smi, {field: entry[field] for field in fields if field in entry})
+                                  for smi, entry in entries.items())
+        return {'key': self.key, 'entries': entries}
+
+    def restore(self, saved):
+        """Restores the contents saved by state - only the conformers are kept if saved under a different key"""
+        entries = saved['entries']
+        if saved['key'] != self.key:
+            entries = OrderedDict((smi, {'conformer': entry['conformer']}) for smi, entry in entries.items()
+                                  if 'conformer' in entry)
+        self.entries = entries
+        self.soap_order = OrderedDict((smi, None) for smi, entry in entries.items() if 'soap' in entry)
+        self._evict()
+
+    def save(self, path=None):
+        path = path if path is not None else self.path
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(self.state(), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path) # don't leave a half-written cache behind if the job is killed
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            self.restore(pickle.load(f))
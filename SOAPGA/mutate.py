@@ -2,7 +2,6 @@
 Written by Jan H. Jensen 2018
 '''
 from rdkit import Chem
-from rdkit.Chem import AllChem
 
 import random
 import numpy as np
@@ -15,6 +14,10 @@ import crossover as co
 from rdkit import rdBase
 rdBase.DisableLog('rdApp.error')
 
+# every element that a mutation can introduce - change_atom swaps between these, append_atom and insert_atom use subsets
+atomic_numbers = [6,7,8,9,16,17,35]
+atom_symbols = [Chem.GetPeriodicTable().GetElementSymbol(n) for n in atomic_numbers]
+
 def delete_atom():
   choices = ['[*:1]~[D1:2]>>[*:1]', '[*:1]~[D2:2]~[*:3]>>[*:1]-[*:3]',
              '[*:1]~[D3:2](~[*;!H0:3])~[*:4]>>[*:1]-[*:3]-[*:4]',
@@ -84,11 +87,11 @@ def add_ring():
   return np.random.choice(choices, p=p)
 
 def change_atom(mol):
-  choices = ['#6','#7','#8','#9','#16','#17','#35']
+  choices = ['#'+str(n) for n in atomic_numbers]
   p = [0.15,0.15,0.14,0.14,0.14,0.14,0.14]
   
   X = np.random.choice(choices, p=p)
-  while not mol.HasSubstructMatch(Chem.MolFromSmarts('['+X+']')):
+  while not mol.HasSubstructMatch(co.smarts('['+X+']')):
     X = np.random.choice(choices, p=p)
   Y = np.random.choice(choices, p=p)
   while Y == X:
@@ -116,7 +119,7 @@ def mutate(mol,mutation_rate):
     
     #print 'mutation',rxn_smarts
     
-    rxn = AllChem.ReactionFromSmarts(rxn_smarts)
+    rxn = co.reaction(rxn_smarts) # memoized - there are only a few dozen distinct mutation SMARTS
 
     new_mol_trial = rxn.RunReactants((mol,))
     
@@ -0,0 +1,102 @@
+"""Crossover + mutation of a mating pool, serially or split into seeded tasks for worker processes or MPI ranks"""
+
+import random
+
+import numpy as np
+
+import crossover as co
+import mutate as mu
+
+
+selection_schemes = ('roulette', 'tournament', 'rank')
+
+
+def select_parents(fitness, n, scheme='roulette', tournament_size=4):
+    """
+    Draws the indices of n parents in a single vectorized call (drawing them one np.random.choice call at a time
+    re-validates the probability vector for every parent)
+
+    :param fitness: fitness of the population, raw or normalized
+    :param scheme: 'roulette' - probability proportional to fitness (uniform if all the fitnesses are 0)
+                   'tournament' - the fittest of tournament_size members drawn uniformly with replacement
+                   'rank' - probability proportional to the fitness rank (1 for the least fit), so a few molecules
+                    with outlying fitnesses don't take over the mating pool
+    :param tournament_size: number of members in each tournament
+
+    :return: (n,) array of indices into the population
+    """
+    fitness = np.asarray(fitness, dtype=float)
+    if scheme == 'tournament':
+        contestants = np.random.randint(len(fitness), size=(n, tournament_size))
+        return contestants[np.arange(n), np.argmax(fitness[contestants], axis=1)]
+    if scheme == 'rank':
+        p = np.empty(len(fitness))
+        p[np.argsort(fitness, kind='stable')] = np.arange(1, len(fitness) + 1)
+    elif scheme == 'roulette':
+        p = fitness
+    else:
+        raise ValueError('selection scheme should be one of {}'.format(selection_schemes))
+    return np.random.choice(len(fitness), size=n, p=p / np.sum(p) if np.sum(p) > 0 else None)
+
+
+def make_children(mating_pool, n_attempts, mutation_rate, seed=None):
+    """
+    Makes children from parents drawn at random from the mating pool, crossing them over and mutating the result
+
+    :param mating_pool: list of RDKit molecules
+    :param n_attempts: number of crossovers tried - attempts where crossover or mutation fails give no child
+    :param mutation_rate: hyperparameter determining the likelihood of mutations occuring
+    :param seed: if given, the Python and NumPy RNGs are seeded with it for the duration of the call (and restored
+     afterwards), so the children only depend on the seed and not on which process or rank makes them
+
+    :return: list of RDKit molecules
+    """
+    if seed is not None:
+        states = random.getstate(), np.random.get_state()
+        random.seed(int(seed))
+        np.random.seed(int(seed))
+
+    children = []
+    for n in range(n_attempts):
+        parent_A = random.choice(mating_pool)
+        parent_B = random.choice(mating_pool)
+        new_child = co.crossover(parent_A, parent_B)
+        if new_child is not None:
+            new_child = mu.mutate(new_child, mutation_rate)
+            if new_child is not None:
+                children.append(new_child)
+
+    if seed is not None:
+        random.setstate(states[0])
+        np.random.set_state(states[1])
+    return children
+
+
+def split_attempts(n_attempts, n_tasks):
+    """
+    Splits the crossover attempts of a generation into n_tasks contiguous shares, each with its own seed drawn from
+    the (already seeded or checkpointed) NumPy RNG of the calling process - so a run is reproducible for a given
+    number of tasks
+
+    :return: seeds, counts - arrays of length n_tasks
+    """
+    seeds = np.random.randint(2**31 - 1, size=n_tasks)
+    counts = np.diff(np.linspace(0, n_attempts, n_tasks + 1).astype(int))
+    return seeds, counts
+
+
+def init_worker(average_size, size_stdev):
+    """Pool initializer - the crossover size parameters are set in main, which pool workers don't run"""
+    co.average_size = average_size
+    co.size_stdev = size_stdev
+
+
+def pool_children(pool, mating_pool, n_attempts, mutation_rate, n_tasks):
+    """
+    Makes children with a multiprocessing pool (started with init_worker), split into n_tasks seeded tasks
+
+    :return: list of RDKit molecules, in task order
+    """
+    seeds, counts = split_attempts(n_attempts, n_tasks)
+    results = pool.starmap(make_children, [(mating_pool, count, mutation_rate, seed) for seed, count in zip(seeds, counts)])
+    return [child for children in results for child in children]
@@ -18,30 +18,71 @@
 from __future__ import print_function
 
 from rdkit import Chem
+from rdkit import RDConfig
 from rdkit.Chem import rdMolDescriptors
-from rdkit.six.moves import cPickle
-from rdkit.six import iteritems
 
 import math
+import gzip
+import pickle
+import multiprocessing as mp
 from collections import defaultdict
 
 import os.path as op
+import numpy as np
 
 _fscores = None
 
 
+class FragmentScores(object):
+  """
+  Fragment score table as two sorted arrays (fingerprint bit IDs and their scores) searched with np.searchsorted,
+  instead of a Python dict with ~700k entries - a tenth of the memory, and it loads from .npz in milliseconds
+  """
+  def __init__(self, keys, scores):
+    self.keys = keys
+    self.scores = scores
+
+  def lookup(self, bitIds, default=-4):
+    """Scores of an array of bit IDs, default for those not in the table"""
+    bitIds = np.asarray(bitIds, dtype=self.keys.dtype)
+    ind = np.minimum(np.searchsorted(self.keys, bitIds), len(self.keys) - 1)
+    return np.where(self.keys[ind] == bitIds, self.scores[ind], default)
+
+  def get(self, bitId, default=-4):
+    return float(self.lookup([bitId], default)[0])
+
+
 def readFragmentScores(name='fpscores'):
-  import gzip
+  """
+  Loads the fragment scores into the module-level table. name is the path without extension: name.npz (as written by
+  a previous call) is used if it exists, otherwise name.pkl.gz is converted and the .npz saved next to it - except for
+  RDKit's own copy. fpscores.pkl.gz isn't part of this repo - by default it is looked for next to this file, then in
+  RDKit's Contrib directory (Contrib/SA_Score/fpscores.pkl.gz).
+  """
   global _fscores
   # generate the full path filename:
   if name == "fpscores":
     name = op.join(op.dirname(__file__), name)
-  _fscores = cPickle.load(gzip.open('%s.pkl.gz' % name))
+    if not op.exists(name + '.npz') and not op.exists(name + '.pkl.gz'):
+      name = op.join(RDConfig.RDContribDir, 'SA_Score', 'fpscores')
+  if op.exists(name + '.npz'):
+    with np.load(name + '.npz') as data:
+      _fscores = FragmentScores(data['keys'], data['scores'])
+    return
+  with gzip.open('%s.pkl.gz' % name) as f:
+    data = pickle.load(f)
   outDict = {}
-  for i in _fscores:
+  for i in data:
     for j in range(1, len(i)):
       outDict[i[j]] = float(i[0])
-  _fscores = outDict
+  keys = np.fromiter(outDict.keys(), dtype=np.int64, count=len(outDict))
+  order = np.argsort(keys)
+  _fscores = FragmentScores(keys[order], np.fromiter(outDict.values(), dtype=np.float64, count=len(outDict))[order])
+  if not name.startswith(RDConfig.RDContribDir):
+    try:
+      np.savez(name + '.npz', keys=_fscores.keys, scores=_fscores.scores)
+    except OSError:
+      pass
 
 
 def numBridgeheadsAndSpiro(mol, ri=None):
@@ -58,13 +99,9 @@ def calculateScore(m):
   fp = rdMolDescriptors.GetMorganFingerprint(m,
                                              2)  #<- 2 is the *radius* of the circular fingerprint
   fps = fp.GetNonzeroElements()
-  score1 = 0.
-  nf = 0
-  for bitId, v in iteritems(fps):
-    nf += v
-    sfp = bitId
-    score1 += _fscores.get(sfp, -4) * v
-  score1 /= nf
+  bitIds = np.fromiter(fps.keys(), dtype=np.int64, count=len(fps))
+  counts = np.fromiter(fps.values(), dtype=np.float64, count=len(fps))
+  score1 = float(np.dot(_fscores.lookup(bitIds), counts) / np.sum(counts))
 
   # features score
   nAtoms = m.GetNumAtoms()
@@ -114,6 +151,34 @@ def calculateScore(m):
   return sascore
 
 
+def _initWorker(name):
+  readFragmentScores(name)
+
+
+def _scoreOrNan(m):
+  return calculateScore(m) if m is not None else float('nan')
+
+
+def calculateScores(mols, n_procs=1, chunksize=256, name='fpscores'):
+  """
+  SA scores of a list or iterator of molecules (eg a GA population or an enumerated library), in a process pool if
+  n_procs > 1 - the fragment table is loaded once per worker, and an iterator is consumed lazily in chunks
+
+  :param mols: RDKit molecules, None entries (failed parses) get a score of nan
+  :param n_procs: number of worker processes
+  :param chunksize: molecules sent to a worker at a time
+  :param name: fragment score file, see readFragmentScores
+
+  :return: list of scores, in the order of mols
+  """
+  if n_procs <= 1:
+    if _fscores is None:
+      readFragmentScores(name)
+    return [_scoreOrNan(m) for m in mols]
+  with mp.Pool(n_procs, initializer=_initWorker, initargs=(name,)) as pool:
+    return list(pool.imap(_scoreOrNan, mols, chunksize=chunksize))
+
+
 def processMols(mols):
   print('smiles\tName\tsa_score')
   for i, m in enumerate(mols):
@@ -0,0 +1,319 @@
+"""SOAP similarity scoring of a population against the target ligand field, shared by GA-soap.py and GA-soap-mpi.py"""
+
+import os
+import time
+import pickle
+from functools import lru_cache
+
+import numpy as np
+from ase import Atoms
+from dscribe.descriptors import SOAP
+from sklearn.preprocessing import normalize
+
+from conformers import embed_population
+from mol_cache import canonical_smiles, atoms_hash
+import mutate as mu
+from soap_kernels import TargetKernel
+
+
+def species_alphabet(tgt_species, population=()):
+    """
+    Fixed list of atomic species for the whole run: the target species, the elements mutations can introduce
+    (mutate.atom_symbols) and the elements of the initial population. Crossover only recombines existing atoms, so no
+    molecule the GA produces can fall outside this list, and the SOAP feature space stays the same every generation.
+
+    :param tgt_species: atomic species present in the target ligand field - from read_xyz
+    :param population: initial population of RDKit molecules
+    :return: sorted list of species
+    """
+    species = set(tgt_species).union(mu.atom_symbols)
+    for mol in population:
+        if mol is not None:
+            species.update(atom.GetSymbol() for atom in mol.GetAtoms())
+    return sorted(species)
+
+
+@lru_cache(maxsize=16)
+def soap_generator(species, rcut, sigma, nmax=8, lmax=6):
+    """dscribe SOAP generator for a tuple of species, built once per feature space"""
+    return SOAP(species=list(species), periodic=False, rcut=rcut, nmax=nmax, lmax=lmax, sigma=sigma, sparse=True)
+
+
+class TargetSOAP(object):
+    """
+    Normalized SOAP descriptors of the target ligand field(s). These never change during a run, so they are computed
+    once per feature space - keyed by (species, rcut, sigma, nmax, lmax) - and optionally persisted to a .pkl file.
+    The file starts with a hash of the target atoms, and is ignored if it was made for different target coordinates;
+    each feature space is then appended to it as one (key, descriptors) record, so adding one doesn't rewrite the rest.
+    """
+    def __init__(self, tgt_atoms, tgt_atoms2=None, path=None, readonly=False):
+        """
+        :param tgt_atoms, tgt_atoms2: lists of ASE atom objects of the target ligand field(s) - from read_xyz
+        :param path: optional .pkl file the descriptors are loaded from (if it exists) and saved to
+        :param readonly: never write path (eg on MPI ranks other than 0)
+        """
+        self.tgt_atoms = tgt_atoms
+        self.tgt_atoms2 = tgt_atoms2
+        self.tgt_hash = atoms_hash(tgt_atoms + tgt_atoms2) if tgt_atoms2 is not None else atoms_hash(tgt_atoms)
+        self.path = path
+        self.readonly = readonly
+        self.descriptors = {}
+        self.kernels = {}
+        self._end = None # length of the valid part of path, None until it holds this target's header
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def load(self, path):
+        """Reads the records of path - a record cut short (eg by a crash while appending) is dropped"""
+        with open(path, 'rb') as f:
+            try:
+                header = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                header = None
+            if header is None or header['tgt_hash'] != self.tgt_hash:
+                print('Target SOAP file {} was made for a different target, recomputing'.format(path))
+                return
+            while True:
+                self._end = f.tell()
+                try:
+                    key, descriptors = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError):
+                    break
+                self.descriptors[key] = descriptors
+
+    def get(self, generator, species, rcut, sigma, nmax, lmax):
+        """
+        :param generator: dscribe SOAP object built with the given parameters
+        :return: tgt_soap, tgt_soap2 - lists holding the normalized descriptor matrix of each site, tgt_soap2 is None
+         for a single site
+        """
+        key = (tuple(sorted(species)), rcut, sigma, nmax, lmax)
+        if key not in self.descriptors:
+            tgt_soap = [normalize(generator.create(self.tgt_atoms), copy=False)]
+            tgt_soap2 = None
+            if self.tgt_atoms2 is not None:
+                tgt_soap2 = [normalize(generator.create(self.tgt_atoms2), copy=False)]
+            self.descriptors[key] = (tgt_soap, tgt_soap2)
+            if self.path is not None and not self.readonly:
+                self.append(key)
+        return self.descriptors[key]
+
+    def get_kernels(self, generator, species, rcut, sigma, nmax, lmax, kernel):
+        """
+        :return: soap_kernels.TargetKernel of each site (the second is None for a single site) - built once per feature
+         space and kernel, so the target self-similarities and the REMatch warm start carry over between generations
+        """
+        key = (tuple(sorted(species)), rcut, sigma, nmax, lmax, kernel)
+        if key not in self.kernels:
+            tgt_soap, tgt_soap2 = self.get(generator, species, rcut, sigma, nmax, lmax)
+            self.kernels[key] = (TargetKernel(tgt_soap[0], kernel),
+                                 TargetKernel(tgt_soap2[0], kernel) if tgt_soap2 is not None else None)
+        return self.kernels[key]
+
+    def append(self, key):
+        """Appends the descriptors of one feature space to self.path, writing the whole file if it isn't ours yet"""
+        if self._end is None:
+            self.save()
+            return
+        with open(self.path, 'ab') as f:
+            f.truncate(self._end)
+            pickle.dump((key, self.descriptors[key]), f, protocol=pickle.HIGHEST_PROTOCOL)
+            self._end = f.tell()
+
+    def save(self, path=None):
+        """Writes the header and every feature space to path (self.path by default)"""
+        path = path if path is not None else self.path
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump({'tgt_hash': self.tgt_hash}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            for key, descriptors in self.descriptors.items():
+                pickle.dump((key, descriptors), f, protocol=pickle.HIGHEST_PROTOCOL)
+            end = f.tell()
+        os.replace(path + '.tmp', path)
+        if path == self.path:
+            self._end = end
+
+
+def describe_molecules(generator, conformers, n_jobs=1):
+    """
+    Normalized per-atom SOAP descriptors of a list of conformers, one ASE Atoms object per molecule so that every atom
+    sees its neighbours within rcut
+
+    :param generator: dscribe SOAP object
+    :param conformers: list of (symbols, positions) from conformers.embed_molecule
+    :param n_jobs: number of processes dscribe splits the molecules over
+
+    :return: list of (n_atoms, n_features) sparse matrices, one per molecule
+    """
+    population_ase = [Atoms(symbols=symbols, positions=positions) for symbols, positions in conformers]
+    if len(population_ase) == 1:
+        return [normalize(generator.create(population_ase[0]), copy=False)]
+    soap = generator.create(population_ase, n_jobs=n_jobs)
+    if isinstance(soap, list): # molecules of different sizes come back as one matrix per molecule
+        return [normalize(mol_soap, copy=False) for mol_soap in soap]
+    # molecules all of the same size come back stacked into a single matrix
+    soap = normalize(soap, copy=False)
+    n_atoms = len(population_ase[0])
+    return [soap[i*n_atoms:(i+1)*n_atoms] for i in range(len(population_ase))]
+
+
+def cache_key(rcut, sigma, kernel, target):
+    """
+    Settings key for a MolCache of scores from score_population - includes the descriptor layout, so that caches
+    written before SOAP was computed per molecule (rather than per isolated atom) are not reused
+    """
+    return ('molecule', rcut, sigma, kernel, target.tgt_hash)
+
+
+def dedup_population(population):
+    """
+    Collapses a population onto its unique molecules (by canonical SMILES) - the mating pool is sampled with
+    replacement, so a generation typically holds many copies of the same molecule
+
+    :param population: list of RDKit molecule objects
+    :return: unique_population, unique_smiles, inverse - population[i] is a copy of unique_population[inverse[i]], so
+     per-molecule results are scattered back with results[inverse]
+    """
+    smiles = [canonical_smiles(m) for m in population]
+    unique_smiles, first, inverse = np.unique(smiles, return_index=True, return_inverse=True)
+    return [population[i] for i in first], unique_smiles.tolist(), inverse.astype(int)
+
+
+def score_population(population, rcut, sigma, kernel, tgt_atoms, tgt_species, tgt_atoms2=None, cache=None,
+                     n_procs=1, embed_timeout=None, n_confs=1, n_threads=0, verbose=True, smiles=None, target=None,
+                     species=None, n_jobs=1, timings=None, count_lookups=True):
+    """
+    Calculates the raw (unnormalized) SOAP similarity of each molecule to the target ligand field(s). Molecules that
+    fail conformer generation get a fitness of 0.
+
+    :param population: list of RDKit molecule objects
+    :param tgt_atoms: list of ASE atom objects of the target ligand field - from read_xyz, second is optional if separate sites
+    :param tgt_species: list of the atomic species present in the target ligand field - from read_xyz
+    :param rcut, sigma: SOAP parameters
+    :param kernel: 'average' or 'rematch'
+    :param cache: optional MolCache - molecules with a cached fitness skip conformer generation and SOAP entirely,
+     and cached conformers are reused
+    :param n_procs, embed_timeout, n_confs, n_threads: conformer generation settings, see conformers.embed_population
+    :param verbose: print timings
+    :param smiles: canonical SMILES of the population, if already known (eg from dedup_population)
+    :param target: optional TargetSOAP of tgt_atoms (and tgt_atoms2), so that the target descriptors are reused
+    :param species: fixed species list from species_alphabet - if None, the species are taken from the molecules being
+     scored, so the SOAP feature space changes from call to call and SOAP descriptors are not cached
+    :param n_jobs: number of processes used by dscribe for the SOAP descriptors
+    :param timings: optional timings.StageTimer the embed/SOAP/kernel times and molecule counts are added to
+    :param count_lookups: count the fitness lookups towards the cache hit ratio - False when the caller has already
+     looked the molecules up (and counted them) itself
+
+    :return: fitness
+    """
+    t0 = time.time()
+    fixed_species = species is not None
+
+    if smiles is None:
+        smiles = [canonical_smiles(m) for m in population]
+    fitness = np.zeros(len(population))
+
+    # look up what is already known about each molecule
+    todo = []
+    conformers = {}
+    for ind, smi in enumerate(smiles):
+        cached_fitness = cache.get(smi, 'fitness', count=count_lookups) if cache is not None else None
+        if cached_fitness is not None:
+            fitness[ind] = cached_fitness
+            continue
+        todo.append(ind)
+        cached_conformer = cache.get(smi, 'conformer', count=False) if cache is not None else None
+        if cached_conformer is not None:
+            conformers[ind] = cached_conformer
+
+    # generate the missing conformers
+    to_embed = [ind for ind in todo if ind not in conformers]
+    for ind, conformer in zip(to_embed, embed_population([population[ind] for ind in to_embed], n_procs=n_procs,
+                                                         timeout=embed_timeout, n_confs=n_confs, n_threads=n_threads)):
+        conformers[ind] = conformer
+        if conformer is not None and cache is not None:
+            cache.update(smiles[ind], conformer=conformer)
+    n_failed = sum(conformers[ind] is None for ind in to_embed)
+
+    good_mols = [ind for ind in todo if conformers[ind] is not None]
+    if species is None:
+        # find unique atomic species for SOAP generation, including the atom types present in the ligand targets
+        species = ['C']
+        for ind in good_mols:
+            for symbol in conformers[ind][0]:
+                if symbol not in species:
+                    species.append(symbol)
+        for atom in tgt_species:
+            if atom not in species:
+                species.append(atom)
+        # dscribe orders the species internally, so sorting doesn't change the descriptors - it only makes the same
+        # species set give the same key (for the target descriptors, kernels and cached SOAP) whatever the molecule
+        # order
+        species = sorted(species)
+    else:
+        # molecules with elements outside the fixed alphabet can't be described - score them as failures
+        n_good = len(good_mols)
+        good_mols = [ind for ind in good_mols if set(conformers[ind][0]).issubset(species)]
+        if verbose and len(good_mols) < n_good:
+            print('{} molecules contain species outside the fixed species list, fitness set to 0'.format(n_good - len(good_mols)))
+    t1 = time.time()
+    if verbose:
+        print('Time taken to generate conformers: {}'.format(t1-t0))
+    if timings is not None:
+        timings.add('embed', t1-t0)
+        timings.count('n_scored', len(todo))
+        timings.count('n_embed_failed', n_failed)
+
+    if len(good_mols) == 0:
+        return fitness
+
+    # reuse cached SOAP matrices computed in the same feature space - only with a fixed species list, otherwise the
+    # feature space rarely repeats and the (large) matrices would just fill the cache
+    cache_soap = cache is not None and fixed_species
+    soap_key = tuple(species)
+    soap = [None]*len(good_mols)
+    to_describe = []
+    for n, ind in enumerate(good_mols):
+        if cache_soap and cache.get(smiles[ind], 'soap_key', count=False) == soap_key:
+            soap[n] = cache.get(smiles[ind], 'soap', count=False)
+        else:
+            to_describe.append(n)
+
+    # Generate SOAP descriptors using dscribe
+    generator = soap_generator(tuple(species), rcut, sigma)
+    if target is None:
+        target = TargetSOAP(tgt_atoms, tgt_atoms2)
+    # TODO make REMatch kernel args as input args
+    tgt_kernel, tgt_kernel2 = target.get_kernels(generator, species, rcut, sigma, 8, 6, kernel)
+
+    if len(to_describe) > 0:
+        new_soap = describe_molecules(generator, [conformers[good_mols[n]] for n in to_describe], n_jobs=n_jobs)
+        for n, mol_soap in zip(to_describe, new_soap):
+            soap[n] = mol_soap
+
+    t2 = time.time()
+    if verbose:
+        print('Time taken to generate SOAP descriptors: {}'.format(t2-t1))
+    if timings is not None:
+        timings.add('soap', t2-t1)
+
+    if tgt_kernel2 is not None:
+        # calculate fitness score as product of the two fitnesses
+        good_fitness = tgt_kernel.score(soap) * tgt_kernel2.score(soap)
+    else:
+        good_fitness = tgt_kernel.score(soap)
+    fitness[good_mols] = good_fitness
+
+    if cache is not None:
+        for ind, mol_soap, mol_fitness in zip(good_mols, soap, good_fitness):
+            if cache_soap:
+                cache.update(smiles[ind], soap=mol_soap, soap_key=soap_key, fitness=mol_fitness)
+            else:
+                cache.update(smiles[ind], fitness=mol_fitness)
+
+    t3 = time.time()
+    if verbose:
+        print('Time taken to calculate fitness: {}'.format(t3-t2))
+    if timings is not None:
+        timings.add('kernel', t3-t2)
+
+    return fitness
@@ -0,0 +1,148 @@
+"""
+Vectorized SOAP similarity kernels against a fixed target. These give the same normalized similarities as dscribe's
+AverageKernel and REMatchKernel (metric="polynomial", normalize_kernel=True), but score a whole population at once
+instead of looping over (molecule, target) pairs in Python. The average kernel matches dscribe to rounding error.
+REMatch is converged much further than dscribe's default threshold - dscribe stops early, which can leave its values a
+few 1e-5 off the converged ones for sparse descriptors, so that is how far the two can differ.
+"""
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def sinkhorn(C, row_mask, col_mask, alpha=0.1, threshold=1e-3, v0=None, max_iter=10000):
+    """
+    Batched entropy-regularized matching (the REMatch global similarity) of a stack of zero-padded local kernel matrices
+
+    :param C: (batch, n, m) local kernel matrices, padded with zeros
+    :param row_mask, col_mask: (batch, n) and (batch, m) boolean masks of the real (unpadded) rows and columns
+    :param alpha, threshold: REMatch regularization and convergence threshold, as in dscribe's REMatchKernel
+    :param v0: optional (m,) or (batch, m) starting column balancing vector, eg from a previous batch - the converged
+     solution doesn't depend on it, but a good guess cuts the number of iterations. With a loose threshold the result
+     does depend on it, by up to the convergence error
+    :param max_iter: iteration limit
+
+    :return: similarities (batch,), column balancing vectors v (batch, m)
+    """
+    K = np.exp(-(1 - C) / alpha) * row_mask[:, :, None] * col_mask[:, None, :]
+    en = row_mask / row_mask.sum(axis=1, keepdims=True)
+    em = col_mask / col_mask.sum(axis=1, keepdims=True)
+    u = en.copy()
+    v = em.copy() if v0 is None else np.where(col_mask, np.broadcast_to(v0, em.shape), 0)
+
+    active = np.arange(len(C))
+    for _ in range(max_iter):
+        K_a = K[active]
+        u_prev, v_prev = u[active], v[active]
+        Kv = np.einsum('bnm,bm->bn', K_a, v_prev)
+        u_new = np.divide(en[active], Kv, out=np.zeros_like(Kv), where=row_mask[active])
+        Ku = np.einsum('bnm,bn->bm', K_a, u_new)
+        v_new = np.divide(em[active], Ku, out=np.zeros_like(Ku), where=col_mask[active])
+        u[active], v[active] = u_new, v_new
+        error = np.sum((u_new - u_prev)**2, axis=1) / np.sum(u_new**2, axis=1) + \
+                np.sum((v_new - v_prev)**2, axis=1) / np.sum(v_new**2, axis=1)
+        active = active[error > threshold]
+        if len(active) == 0:
+            break
+
+    P = K * u[:, :, None] * v[:, None, :]
+    return np.sum(P * C, axis=(1, 2)), v
+
+
+class TargetKernel(object):
+    """
+    Normalized polynomial-metric SOAP kernel between molecules and one fixed target structure. The target's descriptor
+    matrix (transposed, dense, restricted to its nonzero feature columns) and its self-similarity are computed once; a
+    population is then scored by stacking all of its atoms into one sparse matrix and multiplying it with the target
+    in chunks of atoms.
+
+    For the average kernel each chunk is a single matrix product, the polynomial transform and a per-molecule sum.
+    Note that this is the mean of the local kernel over all atom pairs, as in dscribe - with degree 3 it is not the
+    kernel between the mean descriptors, so the target is kept as a matrix rather than collapsed to its mean.
+    For REMatch the local kernels of a chunk are padded into a (molecules, atoms, target atoms) stack and matched with
+    a batched Sinkhorn iteration, warm-started from the target balancing vector of the previous batch.
+    """
+    def __init__(self, tgt_soap, kernel='average', degree=3, gamma=1, coef0=0, alpha=0.1, threshold=1e-14,
+                 chunk_size=2048):
+        """
+        :param tgt_soap: (n_target_atoms, n_features) normalized SOAP matrix of the target, sparse or dense
+        :param kernel: 'average' or 'rematch'
+        :param degree, gamma, coef0: polynomial metric (gamma*<x, y> + coef0)**degree
+        :param alpha, threshold: REMatch parameters - the threshold is much tighter than dscribe's default (1e-3), so
+         that the scores are converged and don't depend on the warm start, ie on the batches scored before
+        :param chunk_size: approximate number of molecule atoms processed at once, bounds the memory used
+        """
+        assert kernel in ('average', 'rematch'), 'kernel should be either "average" or "rematch"'
+        self.kernel = kernel
+        self.degree, self.gamma, self.coef0 = degree, gamma, coef0
+        self.alpha, self.threshold = alpha, threshold
+        self.chunk_size = chunk_size
+        tgt_soap = sp.csr_matrix(tgt_soap)
+        # feature columns that are zero throughout the target (eg species absent from the target) never contribute
+        self.tgt_cols = np.unique(tgt_soap.indices)
+        self.tgt_t = np.ascontiguousarray(tgt_soap[:, self.tgt_cols].toarray().T)
+        self.v0 = None
+        self.tgt_self = self.self_similarity([tgt_soap])[0]
+
+    def _local(self, x, y_t):
+        """Polynomial local kernel between the rows of x and the columns of y_t (dense arrays)"""
+        return (self.gamma*(x @ y_t) + self.coef0)**self.degree
+
+    def _chunks(self, soap, cols=None):
+        """
+        Stacks the molecule matrices and yields (start, stop, x, seg, pos, n_atoms) for chunks of whole molecules - x is
+        the chunk's atoms as a dense array (SOAP power spectra are only moderately sparse, so dense BLAS products are
+        much faster than sparse ones), seg/pos the molecule and atom index of each row
+
+        :param cols: only keep these feature columns - if None, the columns that are nonzero anywhere in the chunk
+        """
+        n_atoms = np.array([s.shape[0] for s in soap])
+        offsets = np.concatenate(([0], np.cumsum(n_atoms)))
+        X = sp.vstack(soap, format='csr')
+        start = 0
+        while start < len(soap):
+            stop = max(np.searchsorted(offsets, offsets[start] + self.chunk_size, side='right') - 1, start + 1)
+            seg = np.repeat(np.arange(stop - start), n_atoms[start:stop])
+            pos = np.arange(offsets[start], offsets[stop]) - offsets[start:stop][seg]
+            x = X[offsets[start]:offsets[stop]]
+            x = x[:, cols if cols is not None else np.unique(x.indices)].toarray()
+            yield start, stop, x, seg, pos, n_atoms[start:stop]
+            start = stop
+
+    def self_similarity(self, soap):
+        """Unnormalized kernel of each molecule with itself"""
+        k_self = np.zeros(len(soap))
+        for start, stop, x, seg, pos, n_atoms in self._chunks(soap):
+            # pad the chunk into a (molecules, atoms, features) stack, so only the diagonal blocks are multiplied
+            n_max = n_atoms.max()
+            x_pad = np.zeros((stop - start, n_max, x.shape[1]))
+            x_pad[seg, pos] = x
+            mask = np.arange(n_max)[None, :] < n_atoms[:, None]
+            C = self._local(x_pad, x_pad.transpose(0, 2, 1)) * mask[:, :, None] * mask[:, None, :]
+            if self.kernel == 'average':
+                k_self[start:stop] = np.sum(C, axis=(1, 2)) / n_atoms**2
+            else:
+                k_self[start:stop] = sinkhorn(C, mask, mask, self.alpha, self.threshold)[0]
+        return k_self
+
+    def score(self, soap):
+        """
+        :param soap: list of (n_atoms, n_features) normalized SOAP matrices (sparse or dense), one per molecule
+        :return: (n_mols,) array of normalized similarities to the target
+        """
+        if len(soap) == 0:
+            return np.zeros(0)
+        k = np.zeros(len(soap))
+        m = self.tgt_t.shape[1]
+        for start, stop, x, seg, pos, n_atoms in self._chunks(soap, cols=self.tgt_cols):
+            C = self._local(x, self.tgt_t)
+            if self.kernel == 'average':
+                k[start:stop] = np.bincount(seg, weights=np.sum(C, axis=1), minlength=stop-start) / (n_atoms*m)
+            else:
+                C_pad = np.zeros((stop - start, n_atoms.max(), m))
+                C_pad[seg, pos] = C
+                row_mask = np.arange(n_atoms.max())[None, :] < n_atoms[:, None]
+                col_mask = np.ones((stop - start, m), dtype=bool)
+                k[start:stop], v = sinkhorn(C_pad, row_mask, col_mask, self.alpha, self.threshold, v0=self.v0)
+                self.v0 = np.mean(v, axis=0)
+        return k / np.sqrt(self.self_similarity(soap) * self.tgt_self)
@@ -0,0 +1,83 @@
+"""Per-generation stage timings and throughput counters for the SOAP GA, logged as CSV or JSONL for plotting"""
+
+import os
+import csv
+import json
+import time
+from contextlib import contextmanager
+
+
+class StageTimer(object):
+    """
+    Accumulates the time one rank spends in each stage of a generation, along with counts of the molecules it scored
+    and failed to embed. Stage times are exclusive: time recorded to another stage inside a timed block (eg the
+    embed/SOAP/kernel times of a rank's own share of the work while it takes part in a gather) is not counted twice.
+    """
+    stages = ('embed', 'soap', 'kernel', 'gather', 'reproduce')
+
+    def __init__(self, rank=0):
+        self.rank = rank
+        self.reset()
+
+    def reset(self):
+        self.times = dict.fromkeys(self.stages, 0.0)
+        self.counts = {'n_scored': 0, 'n_embed_failed': 0}
+        self.cache_hit_ratio = None
+        self.t0 = time.time()
+
+    def add(self, stage, seconds):
+        self.times[stage] += seconds
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    @contextmanager
+    def stage(self, name):
+        t0, other = time.time(), sum(self.times.values())
+        try:
+            yield
+        finally:
+            self.times[name] += time.time() - t0 - (sum(self.times.values()) - other)
+
+    def record(self, generation, cache=None):
+        """
+        Returns the generation's numbers as a dict (one TimingLog row) and starts counting the next generation
+
+        :param cache: optional MolCache of this rank, for the hit ratio if it wasn't already set through cache_hit_ratio
+        """
+        if self.cache_hit_ratio is None and cache is not None:
+            self.cache_hit_ratio = cache.hit_ratio()
+        scoring_time = self.times['embed'] + self.times['soap'] + self.times['kernel']
+        row = {'generation': generation, 'rank': self.rank, 'wall': time.time() - self.t0}
+        row.update(self.times)
+        row.update(self.counts)
+        row['mols_per_sec'] = self.counts['n_scored'] / scoring_time if scoring_time > 0 else 0.0
+        row['cache_hit_ratio'] = self.cache_hit_ratio
+        self.reset()
+        return row
+
+
+class TimingLog(object):
+    """Appends StageTimer rows to a .csv file, or to a JSON lines file for any other extension"""
+    fields = ['generation', 'rank', 'wall'] + list(StageTimer.stages) + ['n_scored', 'n_embed_failed', 'mols_per_sec',
+                                                                         'cache_hit_ratio']
+
+    def __init__(self, path, append=False):
+        """
+        :param path: log file
+        :param append: add to an existing log (eg when resuming a run) rather than starting a new one
+        """
+        self.path = path
+        self.csv = path.endswith('.csv')
+        if not append or not os.path.exists(path):
+            with open(path, 'w') as f:
+                if self.csv:
+                    csv.DictWriter(f, self.fields).writeheader()
+
+    def write(self, rows):
+        with open(self.path, 'a') as f:
+            if self.csv:
+                csv.DictWriter(f, self.fields).writerows(rows)
+            else:
+                for row in rows:
+                    f.write(json.dumps(row) + '\n')
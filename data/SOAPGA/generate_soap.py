@@ -1,4 +1,4 @@
-"""Generates the SOAP descriptors for the binding ligand field"""
+"""Generates the SOAP descriptors for the binding ligand field - run with the repository root on PYTHONPATH, for helper.py"""
 import argparse
 
 import numpy as np
@@ -1,4 +1,6 @@
-import numpy as np
+import os
+
+from helper import FragmentStore
 
 ligands = ['0072', '0104', '0161', '0195', '0305', '0354', '0387', '0434', '0678', '0689', '0691', '0692', '0734', '0748',
                '0749','0752','0755','0759','0769','0770','0774','0786','0805','0820','0828','0830','0831','0874',
@@ -14,14 +16,25 @@ site11_ligands = ['0689', '0691','0734','0752','0755','0769','0774','0786','0805
                   '1308','1311','1334','1336','1348','1351','1374','1375','1380','1384','1385',
                   '1402', '1412', '1425','1458','1478','1493']
 
-full_lines = []
-num_atoms = 0
-for ligand in site11_ligands:
-    file = open('xyz/'+ligand+'.xyz','r')
-    lines = file.readlines()
-    num_atoms += int(lines[0])
-    full_lines.extend(lines[2:])
-file = open('xyz/site11_ligands.xyz','w')
-file.write(str(num_atoms))
-file.write('\n\n')
-file.writelines(full_lines)
+# Mpro-x IDs of the covalently bound fragments (one per line, same format as findcandidates.py index files) - without
+# the list the store is saved without covalency metadata, rather than marking every fragment non-covalent
+covalent_ligands = None
+if os.path.exists('covalent_indices.txt'):
+    covalent_ligands = open('covalent_indices.txt').read().splitlines()
+else:
+    print('covalent_indices.txt not found - xyz/fragments.npz is saved without covalency metadata')
+
+# binary coordinate store of every fragment, keyed by Mpro-x ID - the .xyz files are only parsed here
+sites = dict([(ligand, 2) for ligand in site2_ligands] + [(ligand, 11) for ligand in site11_ligands])
+store = FragmentStore.build(['xyz/'+ligand+'.xyz' for ligand in ligands], ligands, sites=sites, covalent=covalent_ligands)
+store.save('xyz/fragments.npz')
+
+# concatenated ligand field of each site, written straight from the store arrays
+for name, site in [('all', None), ('site2', 2), ('site11', 11)]:
+    site_atoms, _ = store.get_site_atoms(site)
+    file = open('xyz/'+name+'_ligands.xyz','w')
+    file.write(str(len(site_atoms)))
+    file.write('\n\n')
+    for symbol, xyz in zip(site_atoms.get_chemical_symbols(), site_atoms.get_positions()):
+        file.write('{}\t{:.5f}\t{:.5f}\t{:.5f}\n'.format(symbol, *xyz))
+    file.close()
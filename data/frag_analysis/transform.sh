@@ -3,5 +3,5 @@ for i in 0072 0104 0161 0195 0305 0354 0387 0434 0678 0689 0691 0692 0734 0748 0
 do
 babel -imol data/Mpro-x${i}_0.mol -oxyz data/${i}.xyz
 done
-python concat_ligands.py
+PYTHONPATH=../.. python concat_ligands.py
 #python generate_soap.py -xyz xyz/all_ligands.xyz -tgt npy/ligand_soap.npy
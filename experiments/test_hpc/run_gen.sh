@@ -10,7 +10,9 @@ size_std=4
 r_cut=3.5
 a_sigm=0.3
 kernel=rematch
+checkpoint=checkpoint.pkl # a requeued job picks up from here
 
 python ../../GA-soap-mpi.py -csv ${init_pop} -tgt ${target1} -tgt2 ${target2} \
     -mut_rate ${mut_rate} -n_gens ${n_gens} -tgt_size=${target_size} \
-    -size_stdev ${size_std} -rcut ${r_cut} -sigma ${a_sigm} -kernel ${kernel}
+    -size_stdev ${size_std} -rcut ${r_cut} -sigma ${a_sigm} -kernel ${kernel} \
+    -checkpoint ${checkpoint} -resume
@@ -2,19 +2,19 @@ import argparse
 
 import numpy as np
 from scipy.spatial.distance import euclidean as euc_dist
-import copy
 
-from helper import read_xyz
+from helper import read_xyz_frames
+from spatial_index import closest_pairs, nearest_neighbour
 
 def unit_vector(vector):
     """ Returns the unit vector of the vector.  """
     return vector / np.linalg.norm(vector)
 
 def dist_angle_calculator(u_frag, u_overlap, v_frag, v_overlap, u_connections = 1, v_connections = 1, verbose=True):
-    u_frag = read_xyz(u_frag)[0].get_positions()
-    u_overlap = read_xyz(u_overlap)[0].get_positions()
-    v_frag = read_xyz(v_frag)[0].get_positions()
-    v_overlap = read_xyz(v_overlap)[0].get_positions()
+    u_frag = read_xyz_frames(u_frag).get_positions(0)
+    u_overlap = read_xyz_frames(u_overlap).get_positions(0)
+    v_frag = read_xyz_frames(v_frag).get_positions(0)
+    v_overlap = read_xyz_frames(v_overlap).get_positions(0)
 
     u_exits, u_linkeds = coordinate_finder(u_frag, u_overlap, u_connections, verbose)
     v_exits, v_linkeds = coordinate_finder(v_frag, v_overlap, v_connections, verbose)
@@ -40,31 +40,15 @@ def distance_angle(u_exit, u_linked, v_exit, v_linked):
 
 
 def coordinate_finder(u_frag, u_overlap, u_connections, verbose = True):
-    #Calculate the coordinates of u_exit
-    min_dist = 3.0*np.ones(u_connections+1)
-    u_exits = np.zeros((u_connections+1, 3))
+    #Calculate the coordinates of u_exit - the fragment atoms closest to the overlapping structure (within 3A)
+    u_exits = np.zeros((u_connections, 3))
+    _, exit_pairs = closest_pairs(u_frag, u_overlap, k=u_connections, max_dist=3.0)
+    u_exits[:len(exit_pairs)] = u_frag[exit_pairs[:, 0]]
 
-    for i, u in enumerate(u_frag):
-        for j, v in enumerate(u_overlap):
-            dist = euc_dist(u, v)
-            min_dist[-1] = dist
-
-            u_exits[-1, :] = copy.deepcopy(u)
-            idx_sort = np.argsort(min_dist)
-            min_dist = min_dist[idx_sort]
-            u_exits = u_exits[idx_sort, :]
-
-    u_exits = u_exits[:-1, :]
+    # the linked atom is the nearest other fragment atom to each exit
     u_linkeds = np.zeros((u_connections, 3))
-    for n, u_exit in enumerate(u_exits):
-        min_dist2 = 3.0
-        for i, u in enumerate(u_frag):
-            dist = euc_dist(u, u_exit)
-            if (0.05 < dist < min_dist2):
-                min_dist2 = dist
-                u_linked = copy.deepcopy(u)
-                idx_linked = i
-        u_linkeds[n, :] = u_linked
+    linked_inds = nearest_neighbour(u_frag, u_exits, min_dist=0.05, max_dist=3.0)
+    u_linkeds[linked_inds >= 0] = u_frag[linked_inds[linked_inds >= 0]]
 
     if verbose == True:
         print(u_exits)
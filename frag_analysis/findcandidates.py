@@ -5,17 +5,19 @@ import subprocess
 import os
 
 import numpy as np
-from scipy.spatial.distance import euclidean as euc_dist
+from scipy.spatial.distance import cdist
 import matplotlib.pyplot as plt
+from ase.io import write as ase_write
 
-from helper import read_xyz
+from helper import read_xyz, read_xyz_frames, FragmentStore
+from spatial_index import FragmentIndex, overlap_pairs
 
 def return_overlap(x1, x2, radius=0.8, n_overlap=3, make_plot=False, verbose=False):
     """
-    Calculates the Euclidean distance matrix between 2 fragments, and returns True or False depending on whether or not
-    the fragments overlap in space, as determined by a threshold on the Euclidean distance.
+    Finds the atom pairs between 2 fragments that lie within radius (via a KD-tree radius search), and returns True or
+    False depending on whether or not the fragments overlap in space, as determined by the number of such pairs.
 
-    :param x1, x2: .xyz files of the fragment atom coordinates
+    :param x1, x2: .xyz files of the fragment atom coordinates, or ASE Atoms objects of already loaded fragments
     :param radius: threshold for determining atom overlap (in angstroms)
     :param n_overlap: number of overlapping atoms for determining fragment pair overlap
     :param make_plot: set to True to plot the euclidean distance matrix
@@ -23,28 +25,21 @@ def return_overlap(x1, x2, radius=0.8, n_overlap=3, make_plot=False, verbose=Fal
     :return:
     """
 
-    # read 2 xyz files
-    u_atoms = read_xyz(x1)[0]
-    v_atoms = read_xyz(x2)[0]
-
-    # loop over atom xyz vectors, calculate euclidean distance
-    dist_mat = np.empty((len(u_atoms),len(v_atoms)))
-    for i, u in enumerate(u_atoms.get_positions()):
-        for j,v in enumerate(v_atoms.get_positions()):
-            dist_mat[i,j] = euc_dist(u, v)
+    # read 2 xyz files (copy Atoms that were passed in, since overlapping atoms get deleted below)
+    u_atoms = read_xyz(x1)[0][0] if isinstance(x1, str) else x1.copy()
+    v_atoms = read_xyz(x2)[0][0] if isinstance(x2, str) else x2.copy()
 
     if make_plot:
+        dist_mat = cdist(u_atoms.get_positions(), v_atoms.get_positions())
         plt.figure(figsize=(7,7))
         plt.matshow(dist_mat, fignum=1)
         cb = plt.colorbar(fraction=0.046, pad=0.04)
         plt.title('Euclidean Distance Matrix')
         plt.savefig('euc_dist.png')
 
-    # apply distance, return True or False for overlap
-    overlap_atoms = np.where(np.less_equal(dist_mat,radius),1,0)
-    num_overlap_atoms = np.sum(overlap_atoms)
-
-    overlap_atom_indices = np.argwhere(np.less_equal(dist_mat,radius)).T
+    # radius search for atom pairs within the overlap threshold
+    overlap_atom_indices = overlap_pairs(u_atoms.get_positions(), v_atoms.get_positions(), radius)
+    num_overlap_atoms = overlap_atom_indices.shape[1]
 
     if num_overlap_atoms>=n_overlap: # choose n_overlap=4 for planar overlap
         u_overlaps =  u_atoms[overlap_atom_indices[0]]
@@ -61,6 +56,52 @@ def return_overlap(x1, x2, radius=0.8, n_overlap=3, make_plot=False, verbose=Fal
             print('No overlap found :(')
         return False, u_atoms, v_atoms, None, None
 
+def load_fragments(xyz_files, store=None):
+    """
+    Reads every fragment .xyz file once and packs the atom coordinates into a single padded array, so that all
+    fragment pairs can be compared without going back to disk.
+
+    :param xyz_files: list of paths to single-frame .xyz files, or fragment IDs if store is given
+    :param store: optional FragmentStore to read the fragments from instead of .xyz files
+    :return: frags, coords, n_atoms - list of XYZFrames (ASE Atoms are built with frag.get_atoms(0) when needed),
+     (n_frags, max_atoms, 3) coordinates padded with NaN and the number of atoms in each fragment
+    """
+    frags = [store.get_frame(x) if store is not None else read_xyz_frames(x) for x in xyz_files]
+    n_atoms = np.array([frag.n_atoms[0] for frag in frags], dtype=int)
+
+    coords = np.full((len(frags), max(n_atoms, default=0), 3), np.nan)
+    for i, frag in enumerate(frags):
+        coords[i, :n_atoms[i]] = frag.get_positions(0)
+    return frags, coords, n_atoms
+
+def batch_overlap(u_coords, v_coords, radius=0.8, chunk_size=1024):
+    """
+    Counts the number of atom pairs within radius for every (u, v) fragment pair in one pass. Pairs whose bounding
+    boxes (padded by radius) don't intersect are skipped, the rest are evaluated as vectorised distance blocks.
+
+    :param u_coords, v_coords: padded coordinate arrays from load_fragments
+    :param radius: threshold for determining atom overlap (in angstroms)
+    :param chunk_size: number of fragment pairs evaluated per block, bounds peak memory
+    :return: (n_u, n_v) array of overlapping atom pair counts
+    """
+    counts = np.zeros((len(u_coords), len(v_coords)), dtype=int)
+    if counts.size == 0:
+        return counts
+
+    # bounding box prefilter - NaN padding is ignored by nanmin/nanmax
+    u_min, u_max = np.nanmin(u_coords, axis=1) - radius, np.nanmax(u_coords, axis=1) + radius
+    v_min, v_max = np.nanmin(v_coords, axis=1), np.nanmax(v_coords, axis=1)
+    boxes_intersect = np.all((u_min[:, None] <= v_max[None]) & (v_min[None] <= u_max[:, None]), axis=-1)
+    u_inds, v_inds = np.nonzero(boxes_intersect)
+
+    # comparisons against NaN padding are always False, so padded atoms never count as overlapping
+    for start in range(0, len(u_inds), chunk_size):
+        u_block = u_coords[u_inds[start:start+chunk_size]]
+        v_block = v_coords[v_inds[start:start+chunk_size]]
+        sq_dists = np.sum((u_block[:, :, None, :] - v_block[:, None, :, :])**2, axis=-1)
+        counts[u_inds[start:start+chunk_size], v_inds[start:start+chunk_size]] = np.sum(sq_dists <= radius**2, axis=(1, 2))
+    return counts
+
 def main(args):
     """
     Loops over covalent and non-covalent fragments, finds the pairs that have planar overlap in 3D space, then writes
@@ -68,31 +109,72 @@ def main(args):
     """
     print('Beginning analysis...')
 
-    f1 = open(args.cov_inds, 'r')
-    covalent_indices = f1.read().splitlines()
+    if args.store is not None and os.path.exists(args.store):
+        # the fragment lists come from the covalency metadata of the store
+        store = FragmentStore.load(args.store)
+        covalent_indices = store.select(covalent=True)
+        non_covalent_indices = store.select(covalent=False)
+    else:
+        f1 = open(args.cov_inds, 'r')
+        covalent_indices = f1.read().splitlines()
+
+        f2 = open(args.ncov_inds, 'r')
+        non_covalent_indices = f2.read().splitlines()
 
-    f2 = open(args.ncov_inds, 'r')
-    non_covalent_indices = f2.read().splitlines()
+        if args.store is not None:
+            # first run - parse the screened fragments once into a store, with their covalency
+            store = FragmentStore.build(['data/covalent/Mpro-x'+u+'_0.xyz' for u in covalent_indices] +
+                                        ['data/non_covalent/Mpro-x'+v+'_0.xyz' for v in non_covalent_indices],
+                                        covalent_indices + non_covalent_indices, covalent=covalent_indices)
+            store.save(args.store)
 
     candidate_file = open(args.out, 'w')
     candidate_file.write('covalent,non_covalent\n')
     n_overlaps = 0
-    for u in covalent_indices:
-        for v in non_covalent_indices:
-            overlap, u_atoms, v_atoms, u_overlaps, v_overlaps = return_overlap('data/covalent/Mpro-x'+u+'_0.xyz',
-                                                                               'data/non_covalent/Mpro-x'+v+'_0.xyz',
-                                                                               radius=args.radius,
-                                                                               n_overlap=args.n_overlap,
-                                                                               verbose=args.verbose)
-            if overlap:
+
+    # load every fragment once, then count overlapping atoms for all covalent/non-covalent pairs in one pass
+    if args.store is not None:
+        u_frags, u_coords, u_n_atoms = load_fragments(covalent_indices, store=store)
+        v_frags, v_coords, v_n_atoms = load_fragments(non_covalent_indices, store=store)
+    else:
+        u_frags, u_coords, u_n_atoms = load_fragments(['data/covalent/Mpro-x'+u+'_0.xyz' for u in covalent_indices])
+        v_frags, v_coords, v_n_atoms = load_fragments(['data/non_covalent/Mpro-x'+v+'_0.xyz' for v in non_covalent_indices])
+    if args.index is not None:
+        # radius search against a (persistent) KD-tree index of the non-covalent fragments, rebuilt if the fragment
+        # list or any fragment's coordinates changed since it was saved
+        v_index = FragmentIndex.load(args.index) if os.path.exists(args.index) else None
+        if v_index is not None and not v_index.matches(v_coords, v_n_atoms, non_covalent_indices):
+            print('Index {} is out of date with the non-covalent fragments - rebuilding it'.format(args.index))
+            v_index = None
+        if v_index is None:
+            v_index = FragmentIndex.from_padded(v_coords, v_n_atoms, non_covalent_indices)
+            v_index.save(args.index)
+        u_index = FragmentIndex.from_padded(u_coords, u_n_atoms, covalent_indices)
+        overlap_counts = u_index.all_overlap_counts(v_index, radius=args.radius)
+    else:
+        overlap_counts = batch_overlap(u_coords, v_coords, radius=args.radius)
+
+    for u_ind, u in enumerate(covalent_indices):
+        for v_ind, v in enumerate(non_covalent_indices):
+            if overlap_counts[u_ind, v_ind]>=args.n_overlap:
                 candidate_file.write(u+','+v+'\n')
                 n_overlaps+=1
+                if args.verbose:
+                    print('Overlap found for {}, {}! Number of overlapping atoms: {}'.format(u, v, overlap_counts[u_ind, v_ind]))
                 if args.write_atoms:
+                    _, u_atoms, v_atoms, u_overlaps, v_overlaps = return_overlap(u_frags[u_ind].get_atoms(0),
+                                                                                 v_frags[v_ind].get_atoms(0),
+                                                                                 radius=args.radius,
+                                                                                 n_overlap=args.n_overlap)
 
                     # copy original .xyz files
                     os.system('mkdir data/overlaps/'+u+'_'+v)
-                    os.system('cp data/covalent/Mpro-x'+u+'_0.xyz data/overlaps/'+u+'_'+v+'/'+u+'_orig.xyz')
-                    os.system('cp data/non_covalent/Mpro-x'+v+'_0.xyz data/overlaps/'+u+'_'+v+'/'+v+'_orig.xyz')
+                    if args.store is not None:
+                        ase_write('data/overlaps/'+u+'_'+v+'/'+u+'_orig.xyz', u_frags[u_ind].get_atoms(0), format='xyz')
+                        ase_write('data/overlaps/'+u+'_'+v+'/'+v+'_orig.xyz', v_frags[v_ind].get_atoms(0), format='xyz')
+                    else:
+                        os.system('cp data/covalent/Mpro-x'+u+'_0.xyz data/overlaps/'+u+'_'+v+'/'+u+'_orig.xyz')
+                        os.system('cp data/non_covalent/Mpro-x'+v+'_0.xyz data/overlaps/'+u+'_'+v+'/'+v+'_orig.xyz')
 
                     # record pair indices
                     f = open('data/overlaps/indices.csv', 'a')
@@ -140,6 +222,13 @@ if __name__ == '__main__':
                         help='radius threshold for determining overlap of fragment atoms')
     parser.add_argument('-n_overlap',type=int, default=4,
                         help='minimum number of atom pairs within threshold for fragment pair to count as overlapping')
+    parser.add_argument('-store', type=str, default=None,
+                        help='path to .npz FragmentStore of the covalent and non-covalent fragments - built from the '
+                             'index files and the .xyz files in data/covalent and data/non_covalent if it does not exist, '
+                             'after which the fragment lists are taken from its covalency metadata.')
+    parser.add_argument('-index', type=str, default=None,
+                        help='path to .npz KD-tree index of the non-covalent fragments (built and saved if missing or out of date). '
+                             'If not set, overlaps are computed with dense distance blocks.')
     parser.add_argument('-write_atoms', type=bool, default=False,
                         help='whether to write fragment .xyz files with overlapping structure deleted.')
     parser.add_argument('-verbose', type=bool, default=False,
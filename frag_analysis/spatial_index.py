@@ -0,0 +1,159 @@
+"""KD-tree spatial index over the atoms of a fragment library, for radius-based overlap queries"""
+
+import hashlib
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def overlap_pairs(x1, x2, radius=0.8):
+    """
+    Finds all atom pairs between 2 sets of coordinates that lie within radius of each other, without building the
+    dense distance matrix.
+
+    :param x1, x2: (n, 3) and (m, 3) arrays of atom coordinates
+    :param radius: threshold for determining atom overlap (in angstroms)
+    :return: (2, n_pairs) array of [x1, x2] atom indices in row-major order, same as np.argwhere(dist_mat <= radius).T
+    """
+    pairs = cKDTree(x1).sparse_distance_matrix(cKDTree(x2), radius, output_type='ndarray')
+    order = np.lexsort((pairs['j'], pairs['i']))
+    return np.stack((pairs['i'][order], pairs['j'][order])).astype(int)
+
+
+def closest_pairs(x1, x2, k=1, max_dist=3.0):
+    """
+    Returns the k closest atom pairs between 2 sets of coordinates, considering only pairs closer than max_dist.
+
+    :param x1, x2: (n, 3) and (m, 3) arrays of atom coordinates
+    :param k: number of pairs to return
+    :param max_dist: distance cutoff (in angstroms)
+    :return: dists, pairs - sorted distances and (n_found, 2) array of [x1, x2] atom indices, n_found <= k
+    """
+    pairs = cKDTree(x1).sparse_distance_matrix(cKDTree(x2), max_dist, output_type='ndarray')
+    pairs = pairs[pairs['v'] < max_dist]
+    order = np.argsort(pairs['v'], kind='stable')[:k]
+    return pairs['v'][order], np.stack((pairs['i'][order], pairs['j'][order]), axis=1).astype(int)
+
+
+def nearest_neighbour(x, points, min_dist=0.05, max_dist=3.0):
+    """
+    For each point, finds the index of the closest atom in x with min_dist < distance < max_dist - min_dist excludes
+    the point itself when points are atoms of x.
+
+    :param x: (n, 3) array of atom coordinates
+    :param points: (m, 3) array of query coordinates
+    :return: (m,) array of atom indices into x, -1 where no atom lies within the window
+    """
+    tree = cKDTree(x)
+    inds = np.full(len(points), -1, dtype=int)
+    for n, point in enumerate(points):
+        neighbours = np.array(tree.query_ball_point(point, max_dist), dtype=int)
+        if len(neighbours) == 0:
+            continue
+        dists = np.linalg.norm(x[neighbours] - point, axis=1)
+        valid = (dists > min_dist) & (dists < max_dist)
+        if np.any(valid):
+            inds[n] = neighbours[valid][np.argmin(dists[valid])]
+    return inds
+
+
+def coords_checksum(coords, n_atoms):
+    """SHA-1 of the atom counts and (float64) coordinates of a fragment library"""
+    sha = hashlib.sha1(np.ascontiguousarray(n_atoms, dtype=np.int64).tobytes())
+    sha.update(np.ascontiguousarray(coords, dtype=np.float64).tobytes())
+    return sha.hexdigest()
+
+
+def _unpad(coords, n_atoms):
+    """Drops the NaN padding of a (n_frags, max_atoms, 3) coordinate array, giving (n_total_atoms, 3)"""
+    coords = np.asarray(coords)
+    mask = np.arange(coords.shape[1])[None, :] < np.asarray(n_atoms)[:, None]
+    return coords[mask]
+
+
+class FragmentIndex(object):
+    """
+    KD-tree over every atom of a fragment library, so that "which fragments have >= n_overlap atom pairs within radius
+    of this fragment" is answered with a radius search rather than a dense distance matrix. The index can be saved to
+    and loaded from an .npz file so it only needs building once per library.
+    """
+    def __init__(self, coords, n_atoms, names=None):
+        """
+        :param coords: (n_total_atoms, 3) array of all fragment atoms, fragments stored contiguously
+        :param n_atoms: number of atoms in each fragment
+        :param names: optional fragment identifiers (eg Mpro-x indices)
+        """
+        self.coords = np.asarray(coords, dtype=float)
+        self.n_atoms = np.asarray(n_atoms, dtype=int)
+        self.offsets = np.concatenate(([0], np.cumsum(self.n_atoms)))
+        self.atom_frag = np.repeat(np.arange(len(self.n_atoms)), self.n_atoms)
+        self.names = list(names) if names is not None else [str(i) for i in range(len(self.n_atoms))]
+        self.tree = cKDTree(self.coords)
+        self.checksum = coords_checksum(self.coords, self.n_atoms)
+
+    def __len__(self):
+        return len(self.n_atoms)
+
+    @classmethod
+    def from_atoms(cls, frags, names=None):
+        """Builds the index from a list of ASE Atoms objects, one per fragment"""
+        n_atoms = [len(frag) for frag in frags]
+        coords = np.concatenate([frag.get_positions() for frag in frags]) if frags else np.empty((0, 3))
+        return cls(coords, n_atoms, names)
+
+    @classmethod
+    def from_padded(cls, coords, n_atoms, names=None):
+        """Builds the index from a NaN-padded (n_frags, max_atoms, 3) coordinate array, eg from load_fragments"""
+        return cls(_unpad(coords, n_atoms), n_atoms, names)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index saved with FragmentIndex.save - the tree itself is rebuilt, which is fast"""
+        with np.load(path) as data:
+            return cls(data['coords'], data['n_atoms'], data['names'].tolist())
+
+    def save(self, path):
+        np.savez(path, coords=self.coords, n_atoms=self.n_atoms, names=np.array(self.names))
+
+    def matches(self, coords, n_atoms, names):
+        """
+        Checks that a (saved) index still describes a fragment library - same fragments in the same order, with the
+        same coordinates
+
+        :param coords: NaN-padded (n_frags, max_atoms, 3) or contiguous (n_total_atoms, 3) coordinates of the library
+        """
+        coords = np.asarray(coords)
+        if coords.ndim == 3:
+            coords = _unpad(coords, n_atoms)
+        return self.names == list(names) and self.checksum == coords_checksum(coords, n_atoms)
+
+    def fragment_positions(self, i):
+        return self.coords[self.offsets[i]:self.offsets[i+1]]
+
+    def overlap_counts(self, x, radius=0.8):
+        """
+        Counts the atom pairs within radius between the coordinates x and every fragment in the index
+
+        :param x: (n, 3) array of atom coordinates of the query fragment
+        :return: (n_frags,) array of overlapping atom pair counts
+        """
+        neighbours = self.tree.query_ball_point(np.asarray(x, dtype=float), radius)
+        hits = np.concatenate([np.asarray(n, dtype=int) for n in neighbours]) if len(neighbours) else np.empty(0, dtype=int)
+        return np.bincount(self.atom_frag[hits], minlength=len(self))
+
+    def find_overlapping(self, x, radius=0.8, n_overlap=4):
+        """Returns the indices of the fragments with >= n_overlap atom pairs within radius of x"""
+        return np.flatnonzero(self.overlap_counts(x, radius) >= n_overlap)
+
+    def all_overlap_counts(self, other, radius=0.8):
+        """
+        Counts overlapping atom pairs between every fragment of this index and every fragment of another index in
+        a single tree-vs-tree search
+
+        :param other: FragmentIndex
+        :return: (len(self), len(other)) array of overlapping atom pair counts
+        """
+        counts = np.zeros((len(self), len(other)), dtype=int)
+        pairs = self.tree.sparse_distance_matrix(other.tree, radius, output_type='ndarray')
+        np.add.at(counts, (self.atom_frag[pairs['i']], other.atom_frag[pairs['j']]), 1)
+        return counts
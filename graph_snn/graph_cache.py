@@ -0,0 +1,192 @@
+"""
+Persistent cache of featurized molecular graphs, so that the training and scoring scripts don't rebuild every DGL graph
+with mol_to_bigraph on each run.
+
+Graphs are keyed by canonical SMILES and built from the canonical molecule, so a molecule gets the same graph however
+its SMILES was written. The cache file records the featurizer version and is ignored if it was made with different
+features. All graphs are packed into contiguous arrays - the edges of every graph, one node feature buffer and one edge
+feature buffer - with per-graph node and edge offsets, saved as a single uncompressed .npz. Loading only reads the
+SMILES and offsets, the edges and feature buffers are memory-mapped and graphs are built as they are asked for.
+
+Run with the repository root on PYTHONPATH, for helper.py.
+"""
+
+import os
+import tempfile
+import argparse
+
+import dgl
+import dgllife
+import numpy as np
+import pandas as pd
+import torch
+from rdkit import Chem
+from dgllife.utils import CanonicalAtomFeaturizer, CanonicalBondFeaturizer, mol_to_bigraph
+
+from helper import _memmap_npz
+
+atom_featurizer = CanonicalAtomFeaturizer()
+bond_featurizer = CanonicalBondFeaturizer()
+
+# change the first part whenever the featurization changes, so that caches holding the old features are rebuilt
+FEATURIZER_VERSION = 'canonical-1/dgllife-' + dgllife.__version__
+
+def canonical_smiles(smi):
+    mol = Chem.MolFromSmiles(smi)
+    return Chem.MolToSmiles(mol) if mol is not None else None
+
+def featurize_mol(mol):
+    return mol_to_bigraph(mol, node_featurizer=atom_featurizer, edge_featurizer=bond_featurizer)
+
+class GraphCache(object):
+    """
+    Featurized graphs keyed by canonical SMILES, backed by an optional .npz file. Graphs missing from the file are
+    featurized on demand and held in memory until save() packs them in with the rest.
+    """
+    def __init__(self, path=None, mmap=True):
+        """
+        :param path: .npz file the graphs are loaded from (if it exists) and saved to
+        :param mmap: memory-map the edges and feature buffers rather than reading them into memory
+        """
+        self.path = path
+        self.n_feats = atom_featurizer.feat_size('h')
+        self.e_feats = bond_featurizer.feat_size('e')
+        self.smiles = []
+        self.node_offsets = np.zeros(1, dtype=np.int64)
+        self.edge_offsets = np.zeros(1, dtype=np.int64)
+        self.edges = np.empty((0, 2), dtype=np.int32)
+        self.node_feats = np.empty((0, self.n_feats), dtype=np.float32)
+        self.edge_feats = np.empty((0, self.e_feats), dtype=np.float32)
+        self.new = {}
+        if path is not None and os.path.exists(path):
+            self.load(path, mmap)
+        self._index = {smi: i for i, smi in enumerate(self.smiles)}
+
+    def __len__(self):
+        return len(self.smiles) + len(self.new)
+    def __contains__(self, smi):
+        return smi in self._index or smi in self.new
+
+    def load(self, path, mmap=True):
+        with np.load(path) as data:
+            if str(data['version']) != FEATURIZER_VERSION:
+                print('Graph cache {} was made with featurizer {}, not {} - ignoring it'.format(
+                    path, data['version'], FEATURIZER_VERSION))
+                return
+            self.smiles = data['smiles'].tolist()
+            self.node_offsets, self.edge_offsets = data['node_offsets'], data['edge_offsets']
+            if not mmap:
+                self.edges, self.node_feats, self.edge_feats = data['edges'], data['node_feats'], data['edge_feats']
+        if mmap:
+            self.edges, self.node_feats, self.edge_feats = [_memmap_npz(path, name)
+                                                            for name in ['edges', 'node_feats', 'edge_feats']]
+
+    def graph(self, i):
+        """Builds the i-th stored graph - the features are copied out of the buffers, since the scripts pop them"""
+        nodes = slice(self.node_offsets[i], self.node_offsets[i+1])
+        edges = slice(self.edge_offsets[i], self.edge_offsets[i+1])
+        src, dst = self.edges[edges].T.astype(np.int64)
+        g = dgl.graph((torch.from_numpy(src), torch.from_numpy(dst)), num_nodes=nodes.stop - nodes.start)
+        g.ndata['h'] = torch.from_numpy(np.array(self.node_feats[nodes]))
+        g.edata['e'] = torch.from_numpy(np.array(self.edge_feats[edges]))
+        return g
+
+    def get(self, smi, add=True):
+        """
+        :param smi: canonical SMILES
+        :param add: keep the graph of a molecule that isn't cached yet for the next save() - otherwise it is featurized
+         and returned, but not kept (eg for a library that is only passed through once)
+        :return: DGLGraph
+        """
+        if smi in self._index:
+            return self.graph(self._index[smi])
+        if smi in self.new:
+            return self.new[smi]
+        g = featurize_mol(Chem.MolFromSmiles(smi))
+        if add:
+            self.new[smi] = g
+        return g
+
+    def graphs(self, smiles_list, add=True):
+        """
+        :param smiles_list: SMILES in any form, they are canonicalized here
+        :return: list of DGLGraphs, None for SMILES RDKit can't parse
+        """
+        graphs = []
+        for smi in smiles_list:
+            smi = canonical_smiles(smi)
+            graphs.append(self.get(smi, add) if smi is not None else None)
+        return graphs
+
+    def save(self, path=None):
+        """
+        Packs the newly featurized graphs in with the stored ones and writes them to path. The file is written under a
+        unique temporary name and moved into place, so concurrent saves can't interleave - but the last one wins, so
+        jobs sharing a cache (eg array jobs) should only read it, and build it beforehand with graph_cache.py
+        """
+        path = path if path is not None else self.path
+        new = list(self.new.items())
+        n_nodes = [g.num_nodes() for smi, g in new]
+        n_edges = [g.num_edges() for smi, g in new]
+        self.smiles = self.smiles + [smi for smi, g in new]
+        self.node_offsets = np.concatenate((self.node_offsets, self.node_offsets[-1] + np.cumsum(n_nodes, dtype=np.int64)))
+        self.edge_offsets = np.concatenate((self.edge_offsets, self.edge_offsets[-1] + np.cumsum(n_edges, dtype=np.int64)))
+        self.edges = np.concatenate([self.edges] + [torch.stack(g.edges(), dim=1).numpy().astype(np.int32) for smi, g in new])
+        self.node_feats = np.concatenate([self.node_feats] + [g.ndata['h'].numpy() for smi, g in new]).astype(np.float32)
+        # molecules without bonds come out of mol_to_bigraph without edge features
+        self.edge_feats = np.concatenate([self.edge_feats] + [g.edata['e'].numpy() if 'e' in g.edata
+                                                              else np.empty((0, self.e_feats)) for smi, g in new]).astype(np.float32)
+        self.new = {}
+        self._index = {smi: i for i, smi in enumerate(self.smiles)}
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path),
+                                         suffix='.tmp', delete=False) as f:
+            np.savez(f, version=np.array(FEATURIZER_VERSION), smiles=np.array(self.smiles, dtype=str),
+                     node_offsets=self.node_offsets, edge_offsets=self.edge_offsets, edges=self.edges,
+                     node_feats=self.node_feats, edge_feats=self.edge_feats)
+        os.replace(f.name, path)
+
+def featurize_smiles(smiles_list, cache_path=None, add=True):
+    """
+    Featurizes a dataset with the canonical atom/bond featurizers, through the graph cache at cache_path if one is
+    given
+
+    :param add: add the molecules not cached yet to the cache file - otherwise it is only read
+
+    :return: graphs, n_feats, e_feats - graphs is None for SMILES RDKit can't parse
+    """
+    if cache_path is None:
+        mols = [Chem.MolFromSmiles(smi) for smi in smiles_list]
+        graphs = [featurize_mol(m) if m is not None else None for m in mols]
+    else:
+        cache = GraphCache(cache_path)
+        graphs = cache.graphs(smiles_list, add)
+        if len(cache.new) > 0:
+            print('Adding {} molecules to graph cache {}'.format(len(cache.new), cache_path))
+            cache.save()
+    return graphs, atom_featurizer.feat_size('h'), bond_featurizer.feat_size('e')
+
+def drop_unparsed(graphs, *arrays):
+    """
+    Drops the molecules RDKit couldn't parse (None graphs from featurize_smiles) along with their rows of arrays
+
+    :return: object array of the remaining graphs, followed by each of arrays with the same rows kept
+    """
+    valid = np.array([g is not None for g in graphs], dtype=bool)
+    if not valid.all():
+        print('Dropping {} SMILES RDKit could not parse'.format(np.sum(~valid)))
+    kept = np.empty(np.sum(valid), dtype=object)
+    kept[:] = [g for g in graphs if g is not None]
+    return (kept,) + tuple(np.asarray(a)[valid] for a in arrays)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Featurizes a dataset into a graph cache ahead of training/scoring')
+
+    parser.add_argument('-input', type=str,
+                        help='.csv/.smi file (optionally gzipped) with a SMILES column')
+    parser.add_argument('-output', type=str,
+                        help='graph cache .npz file, created or added to')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.input, sep=None, engine='python')
+    featurize_smiles(df['SMILES'].values, args.output)
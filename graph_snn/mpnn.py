@@ -11,7 +11,7 @@ import torch.nn as nn
 from dgl.nn.pytorch import Set2Set
 from dgllife.model.gnn import MPNNGNN
 
-__all__ = ['CustomMPNNPredictor', 'MPNN_encoder', 'MPNNPairPredictor','MPNNPairPredictorMulti']
+__all__ = ['CustomMPNNPredictor', 'MPNN_encoder', 'PairScoringMixin', 'MPNNPairPredictor','MPNNPairPredictorMulti']
 
 class MPNN_encoder(nn.Module):
     """MPNN encoder for regression and classification on graphs.
@@ -141,7 +141,29 @@ class CustomMPNNPredictor(nn.Module):
         return self.predict(graph_feats)
 
 
-class MPNNPairPredictor(nn.Module):
+class PairScoringMixin(object):
+    """Scores every pair of two sets of encoded molecules, for the pair predictors - needs the encode/predict of
+    MPNNPairPredictor, whose forward(g1, ..., g2, ...) predicts from encode(g1) - encode(g2)
+    """
+    def score_pairs(self, graph_1, graph_2):
+        """Predictions for every pair of already encoded molecules - the siamese encoder only has to be run once per
+        unique molecule, rather than once per pair as in forward.
+        Parameters
+        ----------
+        graph_1 : float32 tensor of shape (N, node_out_feats)
+            Encodings of the first molecules of the pairs (the g1 of forward), from encode.
+        graph_2 : float32 tensor of shape (M, node_out_feats)
+            Encodings of the second molecules of the pairs (the g2 of forward).
+        Returns
+        -------
+        float32 tensor of shape (N, M, n_tasks)
+            Prediction for each pair, element [i, j] being forward with g1 the i-th molecule of graph_1 and g2 the
+            j-th molecule of graph_2 - the order matters, as the head sees the difference of the encodings.
+        """
+        return self.predict(graph_1[:, None, :] - graph_2[None, :, :])
+
+
+class MPNNPairPredictor(PairScoringMixin, nn.Module):
     """
     Parameters
     ----------
@@ -203,7 +225,7 @@ class MPNNPairPredictor(nn.Module):
         graph_diff = graph_1 - graph_2
         return self.predict(graph_diff)
 
-class MPNNPairPredictorMulti(nn.Module):
+class MPNNPairPredictorMulti(PairScoringMixin, nn.Module):
     """
     Parameters
     ----------
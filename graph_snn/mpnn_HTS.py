@@ -13,8 +13,6 @@ import pandas as pd
 import torch
 from dgllife.model.model_zoo import MPNNPredictor
 from descriptastorus.descriptors import rdNormalizedDescriptors
-from dgllife.utils import CanonicalAtomFeaturizer, CanonicalBondFeaturizer, mol_to_bigraph
-from rdkit import Chem
 from sklearn.metrics import r2_score, mean_squared_error, roc_auc_score, auc, precision_recall_curve
 from sklearn.model_selection import train_test_split, StratifiedKFold
 from torch import nn
@@ -23,6 +21,7 @@ from torch.nn import MSELoss, BCELoss
 from torch.utils.data import DataLoader
 
 from torch.utils.tensorboard import SummaryWriter
+from graph_cache import featurize_smiles, drop_unparsed
 
 #Set torch variables
 torch.autograd.set_detect_anomaly(True)
@@ -79,17 +78,12 @@ def main(args):
     reg_inds = [0,1,2]
     class_inds = [3,4,5,6]
     # print(smiles_list)
-    X = [Chem.MolFromSmiles(m) for m in smiles_list]
 
-    # Initialise featurisers
-    atom_featurizer = CanonicalAtomFeaturizer()
-    bond_featurizer = CanonicalBondFeaturizer()
-
-    e_feats = bond_featurizer.feat_size('e')
-    n_feats = atom_featurizer.feat_size('h')
+    # Featurise, through the graph cache if one is given
+    X, n_feats, e_feats = featurize_smiles(smiles_list, args.graph_cache)
     print('Number of features: ', n_feats)
 
-    X = np.array([mol_to_bigraph(m, node_featurizer=atom_featurizer, edge_featurizer=bond_featurizer) for m in X])
+    X, y = drop_unparsed(X, y)
 
     r2_list = []
     rmse_list = []
@@ -372,6 +366,8 @@ if __name__ == '__main__':
                         help='whether or not to do test/train split')
     parser.add_argument('-debug', action='store_true',
                         help='whether or not to print predictions and model weight gradients')
+    parser.add_argument('-graph_cache', type=str, default=None,
+                        help='graph cache .npz (see graph_cache.py) the molecular graphs are read from and added to')
     args = parser.parse_args()
 
     main(args)
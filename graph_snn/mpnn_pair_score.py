@@ -3,8 +3,13 @@
 Property prediction using a Message-Passing Neural Network.
 """
 
+import os
+import gzip
 import argparse
 import logging
+import itertools
+import multiprocessing as mp
+from collections import deque
 
 
 import dgl
@@ -14,11 +19,10 @@ import torch
 from tqdm import tqdm
 from sklearn.metrics import roc_auc_score, auc, precision_recall_curve
 from sklearn.model_selection import train_test_split
-from torch.nn import functional as F
 from torch.nn import BCELoss
 from torch.utils.data import DataLoader
 from mpnn import MPNNPairPredictorMulti
-from parser import return_score_pairs
+from graph_cache import GraphCache, featurize_smiles
 
 logging.basicConfig(level=logging.INFO)
 if torch.cuda.is_available():
@@ -28,6 +32,35 @@ else:
     print('use CPU')
     device = 'cpu'
 
+MODEL_DIR = '/rds-d2/user/wjm41/hpc-work/models/'
+
+# Collate Function for Dataloader
+def collate(graphs):
+    batched_graph = dgl.batch(graphs)
+    batched_graph.set_n_initializer(dgl.init.zero_initializer)
+    batched_graph.set_e_initializer(dgl.init.zero_initializer)
+    return batched_graph
+
+library_cache = None
+
+def init_worker(cache_path):
+    """Pool initializer - opens the library graph cache (memory-mapped, so every worker shares the pages)"""
+    global library_cache
+    library_cache = GraphCache(cache_path) if cache_path is not None else None
+
+def featurize_batch(smiles_list):
+    """
+    Featurizes a micro-batch of library SMILES, skipping the ones RDKit can't parse - graphs in the library cache are
+    read from it, the others are featurized but not added
+
+    :return: smiles_list, graphs of the valid molecules, boolean mask of the valid molecules
+    """
+    if library_cache is not None:
+        graphs = library_cache.graphs(smiles_list, add=False)
+    else:
+        graphs = featurize_smiles(smiles_list)[0]
+    return smiles_list, [g for g in graphs if g is not None], np.array([g is not None for g in graphs], dtype=bool)
+
 def return_borders(index, dat_len, size):
     borders = np.linspace(0, dat_len, size + 1).astype('int')
 
@@ -35,93 +68,212 @@ def return_borders(index, dat_len, size):
     border_high = borders[index+1]
     return border_low, border_high
 
-# Collate Function for Dataloader
-def collate(sample):
-    graphs_high, graphs_low = map(list, zip(*sample))
-    batched_graph_high = dgl.batch(graphs_high)
-    batched_graph_high.set_n_initializer(dgl.init.zero_initializer)
-    batched_graph_high.set_e_initializer(dgl.init.zero_initializer)
-    batched_graph_low = dgl.batch(graphs_low)
-    batched_graph_low.set_n_initializer(dgl.init.zero_initializer)
-    batched_graph_low.set_e_initializer(dgl.init.zero_initializer)
-    return batched_graph_high, batched_graph_low
+def _smiles_lines(path):
+    """Yields the SMILES column of every non-empty line of a (gzipped) .smi or .csv file with a header line"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        header = f.readline()
+        sep = ',' if ',' in header else None
+        column = header.strip().split(sep).index('SMILES') if 'SMILES' in header else 0
+        for line in f:
+            if line.strip():
+                yield line.split(sep)[column].strip()
 
-def main(args):
-    """
-    :param n_trials: int specifying number of random train/test splits to use
-    :param test_set_size: float in range [0, 1] specifying fraction of dataset to use as test set
-    """
+def count_smiles(path):
+    """Number of molecules in a library file, counted in one streaming pass"""
+    return sum(1 for _ in _smiles_lines(path))
 
-    df_targets = pd.read_csv('data/'+args.input)
-    df_bmarks = pd.read_csv('data/'+args.target+'_hits.csv')
+def read_smiles(path, start=0, stop=None):
+    """
+    Lazily reads molecules start to stop (exclusive) of a library file - a job's contiguous slice from return_borders,
+    without the file being loaded into memory
 
-    index = int(args.index)
-    mpi_size = int(args.size)
-    len_lib = len(df_targets)
-    border_low, border_high = return_borders(index, len_lib, size=mpi_size)
-    df_targets = df_targets[border_low:border_high]
-    preds = []
+    :return: generator of SMILES
+    """
+    return itertools.islice(_smiles_lines(path), start, stop)
 
-    for i in tqdm(range(args.n_batches)):
-        logging.info('Scoring batch #{}'.format(i))
-        new_len = len(df_targets)
-        border_low, border_high = return_borders(i, new_len, size=args.n_batches)
-        batched_df = df_targets[border_low:border_high]
+def chunked(iterable, n):
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, n))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, n))
 
-        X_high, X_low, n_feats, e_feats = return_score_pairs(batched_df, df_bmarks)
+def featurized_batches(smiles, batch_size, n_workers=1, cache_path=None):
+    """
+    Featurizes micro-batches of SMILES in a background pool while the caller runs inference - at most 2*n_workers
+    batches are in flight, so memory stays bounded however long the library is
 
-        data = list(zip(X_high, X_low))
+    :param n_workers: number of featurization processes, 0 featurizes in this process
+    :param cache_path: optional graph cache of the library, eg built beforehand with graph_cache.py
+    :return: generator of featurize_batch results, in input order
+    """
+    if n_workers < 1:
+        init_worker(cache_path)
+        for batch in chunked(smiles, batch_size):
+            yield featurize_batch(batch)
+        return
+    with mp.Pool(n_workers, initializer=init_worker, initargs=(cache_path,)) as pool:
+        pending = deque()
+        for batch in chunked(smiles, batch_size):
+            pending.append(pool.apply_async(featurize_batch, (batch,)))
+            if len(pending) >= 2*n_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
 
-        data_loader = DataLoader(data, batch_size=len(df_bmarks), collate_fn=collate, drop_last=False)
+def load_models(modelnames, n_feats, e_feats, model_dir=MODEL_DIR):
+    """
+    Instantiates each saved pair model once, in eval mode on the device, so that several ensemble members can be held
+    in memory and all of them applied to each featurized batch
 
-        n_tasks = 1
+    :param modelnames: names of the model directories in model_dir, each holding a model_epoch_final.pt
+    :return: list of models, in the order of modelnames
+    """
+    models = []
+    for modelname in modelnames:
         mpnn_net = MPNNPairPredictorMulti(node_in_feats=n_feats,
                                        edge_in_feats=e_feats,
                                        node_out_feats=128,
-                                       n_tasks=n_tasks)
-        mpnn_net.load_state_dict(torch.load('/rds-d2/user/wjm41/hpc-work/models/'+args.modelname+'/model_epoch_final.pt'))
+                                       n_tasks=1)
+        mpnn_net.load_state_dict(torch.load(os.path.join(model_dir, modelname, 'model_epoch_final.pt'),
+                                            map_location=device))
         mpnn_net = mpnn_net.to(device)
-
         mpnn_net.eval()
+        models.append(mpnn_net)
+    return models
 
-        for i, (bg_high, bg_low) in enumerate(data_loader):
-            atom_feats_high = bg_high.ndata.pop('h').to(device)
-            bond_feats_high = bg_high.edata.pop('e').to(device)
-            atom_feats_low = bg_low.ndata.pop('h').to(device)
-            bond_feats_low = bg_low.edata.pop('e').to(device)
-            with torch.no_grad():
-                y_pred = mpnn_net(bg_high, atom_feats_high, bond_feats_high, bg_low, atom_feats_low, bond_feats_low)
-            y_pred = F.sigmoid(y_pred)
+def resume_output(path, columns):
+    """
+    Prepares the output .csv for appending: creates it if needed, otherwise drops any partly written last line left
+    by a killed job
+
+    :param columns: header of the output file
+    :return: number of molecules already scored
+    """
+    if not os.path.exists(path):
+        with open(path, 'w') as f:
+            f.write(','.join(columns) + '\n')
+        return 0
+    n_lines, last_newline, offset = 0, 0, 0
+    with open(path, 'rb+') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            n_lines += block.count(b'\n')
+            if b'\n' in block:
+                last_newline = offset + block.rfind(b'\n') + 1
+            offset += len(block)
+        f.truncate(last_newline)
+    return max(n_lines - 1, 0)
+
+def encode(mpnn_net, graphs, batch_size=256):
+    """
+    Runs the siamese encoder once over each molecule
+
+    :return: generator of (batch_size, node_out_feats) encodings
+    """
+    data_loader = DataLoader(graphs, batch_size=batch_size, collate_fn=collate, drop_last=False)
+    for bg in data_loader:
+        atom_feats = bg.ndata.pop('h').to(device)
+        bond_feats = bg.edata.pop('e').to(device)
+        with torch.no_grad():
+            yield mpnn_net.encode(bg, atom_feats, bond_feats)
 
-            y_pred = y_pred.detach().cpu().numpy()
+def ensemble_scores(models, hits, graphs):
+    """
+    Scores a featurized micro-batch with every ensemble member: the graphs are batched and their features moved to the
+    device once, then each member encodes the same batched graph and scores it against its own hit encodings
 
-            # store labels and preds
-            preds.append(y_pred)
+    :param hits: encodings of the benchmark hits by each model
+    :return: (len(graphs), len(models)) array of the scores averaged over the hits
+    """
+    bg = collate(graphs)
+    atom_feats = bg.ndata.pop('h').to(device)
+    bond_feats = bg.edata.pop('e').to(device)
+    scores = np.empty((len(graphs), len(models)))
+    with torch.no_grad():
+        for j, (mpnn_net, model_hits) in enumerate(zip(models, hits)):
+            # pairs are scored as (library molecule, hit), ie with the library molecule as g1/X_high of forward - the
+            # pairwise loop this replaces took its pairs from parser.return_score_pairs, which isn't in this repo, and
+            # fed them to forward as (X_high, X_low)
+            y_pred = torch.sigmoid(mpnn_net.score_pairs(mpnn_net.encode(bg, atom_feats, bond_feats), model_hits))
+            scores[:, j] = y_pred.mean(dim=1)[:, 0].cpu().numpy()
+    return scores
 
-    preds = np.array(preds).squeeze()
+def main(args):
+    """
+    Streams the library through the pair model(s): SMILES are read lazily, featurized in the background and scored in
+    micro-batches against every benchmark hit, and the average score of each molecule is appended to
+    <savename>_scores_batch_<index>.csv as soon as its micro-batch is done. A rerun of a killed job carries on after the
+    last molecule written.
 
-    #np.savetxt(args.target+'_scores.txt', preds)
-    df_targets['avg_score'] = np.mean(preds, axis=1)
-    df_targets.to_csv(args.savename+'_scores_batch_'+str(index)+'.csv', index=False)
+    With several models the file holds one avg_score_<modelname> column per ensemble member followed by their mean and
+    standard deviation (ensemble_top_score, ensemble_std, as ensemble_preds.py names them), so no per-model score files have
+    to be joined afterwards.
+    """
+
+    df_bmarks = pd.read_csv('data/'+args.target+'_hits.csv')
+
+    index = int(args.index)
+    mpi_size = int(args.size)
+
+    # the cache is only read - every array job shares it, so none of them may rewrite it
+    X_hits, n_feats, e_feats = featurize_smiles(df_bmarks['SMILES'], args.graph_cache, add=False)
+
+    # every ensemble member is loaded once and scores each featurized batch, so one pass gives all the scores
+    models = load_models(args.modelname, n_feats, e_feats, args.model_dir)
+
+    # each hit is encoded once per model, then every library molecule is scored from the differences of the encodings
+    hits = [torch.cat(list(encode(mpnn_net, X_hits))) for mpnn_net in models]
+
+    if len(models) == 1:
+        columns = ['SMILES', 'avg_score']
+    else:
+        columns = ['SMILES'] + ['avg_score_'+modelname for modelname in args.modelname] + ['ensemble_top_score', 'ensemble_std']
+    savename = args.savename+'_scores_batch_'+str(index)+'.csv'
+    n_done = resume_output(savename, columns)
+    if n_done > 0:
+        logging.info('Resuming after {} molecules already in {}'.format(n_done, savename))
+    # each job scores a contiguous slice of the library, the same molecules as before the library was streamed
+    border_low, border_high = return_borders(index, count_smiles('data/'+args.input), mpi_size)
+    smiles = read_smiles('data/'+args.input, border_low + n_done, border_high)
+
+    with open(savename, 'a') as f:
+        for smiles_batch, X_lib, valid in tqdm(featurized_batches(smiles, args.batch_size, args.n_workers, args.graph_cache)):
+            preds = np.full((len(smiles_batch), len(models)), np.nan) # unparseable SMILES are written with nan scores
+            if len(X_lib) > 0:
+                preds[valid] = ensemble_scores(models, hits, X_lib)
+            if len(models) > 1:
+                # sample standard deviation, as pandas computed it when the per-model files were merged
+                preds = np.column_stack([preds, np.mean(preds, axis=1), np.std(preds, axis=1, ddof=1)])
+            f.write(''.join(smi + ''.join(',{}'.format(p) for p in pred) + '\n' for smi, pred in zip(smiles_batch, preds)))
+            f.flush()
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('-n_batches', type=int, default=10,
-                        help='int specifying number of batches for scoring')
-    parser.add_argument('-modelname', type=str, default='multitask_pair',
-                        help='name for directory containing saved model params and tensorboard logs')
+    parser.add_argument('-batch_size', type=int, default=256,
+                        help='number of library molecules featurized and scored at a time')
+    parser.add_argument('-n_workers', type=int, default=1,
+                        help='number of background processes featurizing the library, 0 to featurize in the main process')
+    parser.add_argument('-graph_cache', type=str, default=None,
+                        help='graph cache .npz (see graph_cache.py) the hit and library graphs are read from - it is '
+                             'never written, molecules missing from it are featurized on the fly')
+    parser.add_argument('-modelname', type=str, nargs='+', default=['multitask_pair'],
+                        help='name(s) of the directories containing saved model params - several names (eg the '
+                             'members of an ensemble) are all loaded once and scored in the same pass, one column each')
+    parser.add_argument('-model_dir', type=str, default=MODEL_DIR,
+                        help='directory containing the model directories')
     parser.add_argument('-savename', type=str, default='multitask_pair',
                         help='name for directory containing saved model params and tensorboard logs')
     parser.add_argument('-index', type=str, default='0',
-                        help='integer index for data batching')
+                        help='integer index of this job - it scores the index-th of size contiguous slices of the library')
     parser.add_argument('-size', type=str, default='10',
-                        help='Number of batches in total.')
+                        help='Number of jobs the library is split over.')
     parser.add_argument('-target', type=str, default='acry',
                         help='target series for scoring hits')
     parser.add_argument('-input', type=str,
-                        help='input file of smiles to score relative to the targets.')
+                        help='input file of smiles (.smi or .csv with a SMILES header, optionally gzipped) in data/ to score relative to the targets.')
     parser.add_argument('-dry', action='store_true',
                         help='whether or not to only use a subset of the HTS screen')
     parser.add_argument('-debug', action='store_true',
@@ -10,8 +10,6 @@ from tqdm import tqdm
 import numpy as np
 import torch
 from dgllife.model.model_zoo import MPNNPredictor
-from dgllife.utils import CanonicalAtomFeaturizer, CanonicalBondFeaturizer, mol_to_bigraph
-from rdkit import Chem
 from scipy.stats import pearsonr
 from sklearn.metrics import r2_score, mean_absolute_error, mean_squared_error, roc_auc_score, auc, precision_recall_curve
 from sklearn.model_selection import train_test_split, StratifiedKFold
@@ -22,6 +20,7 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
 from helper import parse_dataset
+from graph_cache import featurize_smiles, drop_unparsed
 # from data_utils import TaskDataLoader
 
 # Adjust accordingly for your own file system
@@ -71,17 +70,12 @@ def main(args):
     # smiles_list, y = data_loader.load_property_data()
 
     smiles_list, y = parse_dataset(args.task, PATHS[args.task], args.reg)
-    X = [Chem.MolFromSmiles(m) for m in smiles_list]
 
-    # Initialise featurisers
-    atom_featurizer = CanonicalAtomFeaturizer()
-    bond_featurizer = CanonicalBondFeaturizer()
-
-    e_feats = bond_featurizer.feat_size('e')
-    n_feats = atom_featurizer.feat_size('h')
+    # Featurise, through the graph cache if one is given
+    X, n_feats, e_feats = featurize_smiles(smiles_list, args.graph_cache)
     print('Number of features: ', n_feats)
 
-    X = [mol_to_bigraph(m, node_featurizer=atom_featurizer, edge_featurizer=bond_featurizer) for m in X]
+    X, y = drop_unparsed(X, y)
 
     r2_list = []
     rmse_list = []
@@ -288,6 +282,8 @@ if __name__ == '__main__':
     parser.add_argument('-ts', '--test_set_size', type=float, default=0.2,
                         help='float in range [0, 1] specifying fraction of dataset to use as test set')
 
+    parser.add_argument('-graph_cache', type=str, default=None,
+                        help='graph cache .npz (see graph_cache.py) the molecular graphs are read from and added to')
     args = parser.parse_args()
 
     main(args)
@@ -12,9 +12,8 @@ import numpy as np
 import pandas as pd
 import torch
 from mpnn import CustomMPNNPredictor
+from graph_cache import featurize_smiles, drop_unparsed
 from descriptastorus.descriptors import rdNormalizedDescriptors
-from dgllife.utils import CanonicalAtomFeaturizer, CanonicalBondFeaturizer, mol_to_bigraph
-from rdkit import Chem
 from sklearn.metrics import r2_score, mean_squared_error, roc_auc_score, auc, precision_recall_curve
 from sklearn.model_selection import train_test_split, StratifiedKFold
 from torch import nn
@@ -83,17 +82,12 @@ def main(args):
     n_tasks = y.shape[1]
     class_inds = [0,1,2]
     reg_inds = [3,4,5]
-    X = [Chem.MolFromSmiles(m) for m in smiles_list]
     descs = np.array([generate_descriptors(m) for m in smiles_list])
-    # Initialise featurisers
-    atom_featurizer = CanonicalAtomFeaturizer()
-    bond_featurizer = CanonicalBondFeaturizer()
-
-    e_feats = bond_featurizer.feat_size('e')
-    n_feats = atom_featurizer.feat_size('h')
+    # Featurise, through the graph cache if one is given
+    X, n_feats, e_feats = featurize_smiles(smiles_list, args.graph_cache)
     print('Number of features: ', n_feats)
 
-    X = np.array([mol_to_bigraph(m, node_featurizer=atom_featurizer, edge_featurizer=bond_featurizer) for m in X])
+    X, y, descs = drop_unparsed(X, y, descs)
 
     r2_list = []
     rmse_list = []
@@ -380,6 +374,8 @@ if __name__ == '__main__':
                         help='whether or not to print tensor values')
     parser.add_argument('-test', action='store_true',
                         help='whether or not to do train/test split')
+    parser.add_argument('-graph_cache', type=str, default=None,
+                        help='graph cache .npz (see graph_cache.py) the molecular graphs are read from and added to')
     args = parser.parse_args()
 
     main(args)
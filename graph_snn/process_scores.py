@@ -17,7 +17,10 @@ parser.add_argument('-input', type=str,
 args = parser.parse_args()
 
 #df = pd.read_csv(args.input, header=0, names=['SMILES','avg_score_1','avg_score_2','avg_score_3','avg_score_4','avg_score_5','avg_score','std'])
-df = pd.read_csv(args.input, header=0, names=['SMILES','avg_score_2','avg_score_3','avg_score_4','avg_score_5','avg_score','std'])
+# ensemble files (any number of models) rank on the ensemble mean, single model score files on their avg_score
+df = pd.read_csv(args.input)
+if 'ensemble_top_score' in df.columns:
+    df = df.rename(columns={'ensemble_top_score': 'avg_score', 'ensemble_std': 'std'})
 smiles_list = df['SMILES'].values
 df_actives = pd.read_csv('data/'+args.target+'_activity.smi')
 df_actives = df_actives[df_actives['activity']==1]
@@ -0,0 +1,41 @@
+import dgl
+import pytest
+import torch
+from rdkit import Chem
+from dgllife.utils import CanonicalAtomFeaturizer, CanonicalBondFeaturizer, mol_to_bigraph
+
+from mpnn import MPNNPairPredictor, MPNNPairPredictorMulti
+
+atom_featurizer = CanonicalAtomFeaturizer()
+bond_featurizer = CanonicalBondFeaturizer()
+
+def featurize(smiles):
+    return [mol_to_bigraph(Chem.MolFromSmiles(smi), node_featurizer=atom_featurizer, edge_featurizer=bond_featurizer)
+            for smi in smiles]
+
+def encode(model, graphs):
+    bg = dgl.batch(graphs)
+    return model.encode(bg, bg.ndata['h'], bg.edata['e'])
+
+@pytest.mark.parametrize('model_class', [MPNNPairPredictor, MPNNPairPredictorMulti])
+def test_score_pairs(model_class):
+    """score_pairs on encodings gives the same predictions as running forward on every pair, in the same order"""
+    torch.manual_seed(0)
+    model = model_class(node_in_feats=atom_featurizer.feat_size('h'), edge_in_feats=bond_featurizer.feat_size('e'),
+                        node_out_feats=32, n_tasks=1)
+    model.eval()
+    graphs_1 = featurize(['CC(=O)Nc1ccc(O)cc1', 'C=CC(=O)N1CCN(Cc2ccccc2)CC1', 'Clc1ccccc1'])
+    graphs_2 = featurize(['O=C(Nc1cccnc1)C1CCCCC1', 'CCO'])
+
+    with torch.no_grad():
+        pairs = model.score_pairs(encode(model, graphs_1), encode(model, graphs_2))
+        reverse = model.score_pairs(encode(model, graphs_2), encode(model, graphs_1))
+        assert pairs.shape == (len(graphs_1), len(graphs_2), 1)
+        for i, g1 in enumerate(graphs_1):
+            for j, g2 in enumerate(graphs_2):
+                forward = model(g1, g1.ndata['h'], g1.edata['e'], g2, g2.ndata['h'], g2.edata['e'])
+                backward = model(g2, g2.ndata['h'], g2.edata['e'], g1, g1.ndata['h'], g1.edata['e'])
+                assert torch.allclose(pairs[i, j], forward[0], atol=1e-5)
+                assert torch.allclose(reverse[j, i], backward[0], atol=1e-5)
+        # the head sees the difference of the encodings, so swapping the arguments changes the scores
+        assert not torch.allclose(pairs, reverse.transpose(0, 1), atol=1e-5)
@@ -1,124 +1,220 @@
+import mmap
+import struct
+import zipfile
+
 import numpy as np
 from ase.atoms import Atoms
 
 def read_xyz(config_file,
             index=':'):
-        species={'C'}
-        atom_list = []
-        mol_list = []
-        num_list = []
-        ifs = open(config_file, 'r')
-        while True:
-            header = ifs.readline().split()
-            if header != []:
+        """
+        Reads a (multi-frame) .xyz file into a list of ASE Atoms objects. Parsing is done by read_xyz_frames - use that
+        directly if only the coordinates are needed, since it avoids building the ASE objects.
+
+        :return: mol_list, num_list, atom_list, species
+        """
+        frames = read_xyz_frames(config_file)
+        mol_list = frames.to_atoms()
+        num_list = frames.n_atoms.tolist()
+        atom_list = [frames.get_chemical_symbols(i) for i in range(len(frames))]
+        species = {'C'}.union(frames.symbols)
+        return mol_list, num_list, atom_list, species
+
+def read_xyz_frames(config_file):
+    """
+    Fast reader for (multi-frame) .xyz files. The file is memory-mapped, line breaks are located with a single
+    vectorised scan and the atom lines of all frames are parsed in one go. The coordinates are parsed as float64 and
+    kept alongside the float32 buffer, so that ASE Atoms carry the coordinates exactly as written in the file.
+
+    :param config_file: path to .xyz file
+    :return: XYZFrames
+    """
+    with open(config_file, 'rb') as fs:
+        try:
+            buf = mmap.mmap(fs.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # mmap refuses empty files
+            return XYZFrames(np.empty((0, 3), dtype=np.float32), np.empty(0, dtype=np.uint8), [], [0], [])
+        with buf:
+            data = np.frombuffer(buf, dtype=np.uint8)
+            line_ends = np.flatnonzero(data == ord('\n'))
+            del data # release the buffer export so that the mmap can be closed
+            if len(line_ends) == 0 or line_ends[-1] != len(buf) - 1:
+                line_ends = np.append(line_ends, len(buf))
+            line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+
+            # walk the frame headers - only atom counts and comment lines are touched here
+            n_list = []
+            comments = []
+            blocks = []
+            line = 0
+            while line < len(line_starts):
+                header = buf[line_starts[line]:line_ends[line]].split()
+                if header == []:
+                    break
                 assert len(header) == 1
                 n_atoms = int(header[0])
-                num_list.append(n_atoms)
-                config = ConfigASE()
-                config.create(n_atoms, ifs)
-                atom_list.append(config.get_chemical_symbols())
-                atoms = set(config.get_chemical_symbols())
-                if (atoms.issubset(species)==False):
-                    species = species.union(atoms)
-                xyz = config.get_positions()
-                mol = Atoms(symbols=config.get_chemical_symbols(), positions= xyz)
-                mol_list.append(mol)
-            else: break
-        return mol_list, num_list, atom_list, species
+                n_list.append(n_atoms)
+                comments.append(buf[line_starts[line+1]:line_ends[line+1]].decode().strip())
+                if n_atoms > 0:
+                    blocks.append(buf[line_starts[line+2]:line_ends[line+1+n_atoms]])
+                line += n_atoms + 2
+
+    # parse the atom lines of every frame at once: element, x, y, z
+    n_total = sum(n_list)
+    tokens = b'\n'.join(blocks).split()
+    if len(tokens) == 4*n_total:
+        table = np.array(tokens).reshape(n_total, 4)
+    else: # extra columns present, fall back to per-line splitting
+        table = np.array([ln.split()[:4] for block in blocks for ln in block.splitlines()]).reshape(n_total, 4)
+    exact_positions = table[:, 1:].astype(np.float64)
+    symbols, codes = np.unique(table[:, 0], return_inverse=True)
+    symbols = [s.decode() for s in symbols]
+
+    return XYZFrames(exact_positions.astype(np.float32), codes.astype(np.uint8), symbols,
+                     np.concatenate(([0], np.cumsum(n_list))), comments, exact_positions)
 
-class ConfigASE(object):
-    def __init__(self):
-        self.info = {}
-        self.cell = None
-        self.pbc = np.array([False, False, False])
-        self.atoms = []
-        self.positions = []
-        self.symbols = []
+class XYZFrames(object):
+    """
+    Struct-of-arrays container for the frames of an .xyz file: one float32 positions buffer for all atoms, one species
+    code per atom (indexing into symbols) and frame offsets into both. ASE Atoms objects are only built when asked for,
+    from the float64 exact_positions if given (float32 rounding would shift eg 6.484 to 6.48400021).
+    """
+    def __init__(self, positions, codes, symbols, offsets, comments, exact_positions=None):
+        self.positions = positions
+        self.exact_positions = np.asarray(positions if exact_positions is None else exact_positions, dtype=np.float64)
+        self.codes = codes
+        self.symbols = symbols
+        self.offsets = np.asarray(offsets, dtype=int)
+        self.n_atoms = np.diff(self.offsets)
+        self.comments = comments
     def __len__(self):
-        return len(self.atoms)
-    def get_positions(self):
-        return self.positions
-    def get_chemical_symbols(self):
-        return self.symbols
-    def create(self, n_atoms, fs):
-        #header = fs.readline().split()
-        # Parse header: key1="str1" key2=123 key3="another value" ...
-        header = fs.readline().replace("\n", "")
-        tokens = []
-        pos0 = 0
-        pos1 = 0
-        status = "<"
-        quotcount = 0
-        while pos1 < len(header):
-            #print tokens, quotcount, status, pos0, pos1, header[pos0:pos1]
-            status_out = status
-            # On the lhs of the key-value pair?
-            if status == "<":
-                if header[pos1] == "=":
-                    tokens.append(header[pos0:pos1])
-                    pos0 = pos1+1
-                    pos1 = pos1+1
-                    status_out = ">"
-                    quotcount = 0
-                else:
-                    pos1 += 1
-            # On the rhs of the key-value pair?
-            elif status == ">":
-                if header[pos1-1:pos1] == '"':
-                    quotcount += 1
-                if quotcount == 0 and header[pos1] == ' ':
-                    quotcount = 2
-                if quotcount <= 1:
-                    pos1 += 1
-                elif quotcount == 2:
-                    tokens.append(header[pos0:pos1])
-                    pos0 = pos1+1
-                    pos1 = pos1+1
-                    status_out = ""
-                    quotcount = 0
-                else:
-                    assert False
-            # In between key-value pairs?
-            elif status == "":
-                if header[pos1] == ' ':
-                    pos0 += 1 pos1 += 1
-                else:
-                    status_out = "<"
-            else:
-                assert False
-            status = status_out
-        kvs = []
-        for i in range(int(len(tokens)/2)):
-            kvs.append([tokens[2*i], tokens[2*i+1]])
-        # Process key-value pairs
-        for kv in kvs:
-            key = kv[0]
-            value = '='.join(kv[1:])
-            value = value.replace('"','').replace('\'','')
-            # Float?
-            if '.' in value:
-                try:
-                    value = float(value)
-                except: pass
-            else:
-                # Int?
-                try:
-                    value = int(value)
-                except: pass
-            self.info[kv[0]] = value
-        # Read atoms
-        self.positions = []
-        self.symbols = []
-        for i in range(n_atoms):
-            ln = fs.readline()
-            ln = ln.split()
-            name = ln[0]
-            pos = list(map(float, ln[1:4]))
-            pos = np.array(pos)
-            self.positions.append(pos)
-            self.symbols.append(name)
-        self.positions = np.array(self.positions)
-        return
+        return len(self.n_atoms)
+    def get_positions(self, i):
+        return self.positions[self.offsets[i]:self.offsets[i+1]]
+    def get_chemical_symbols(self, i):
+        return [self.symbols[c] for c in self.codes[self.offsets[i]:self.offsets[i+1]]]
+    def get_atoms(self, i):
+        return Atoms(symbols=self.get_chemical_symbols(i),
+                     positions=self.exact_positions[self.offsets[i]:self.offsets[i+1]])
+    def to_atoms(self):
+        return [self.get_atoms(i) for i in range(len(self))]
+
+class FragmentStore(object):
+    """
+    Binary store of fragment coordinates keyed by fragment ID (eg the Mpro-x index), with site membership and (when it
+    is known) covalent/non-covalent metadata. All atoms are held in contiguous arrays (as in XYZFrames) with
+    per-fragment offsets, saved as a single uncompressed .npz so that the coordinates can be memory-mapped on load. The
+    positions are kept in float64 (the fragments are small), so that the ASE Atoms built from the store match the .xyz
+    files exactly.
+    """
+    def __init__(self, ids, positions, codes, symbols, offsets, sites, covalent=None):
+        self.ids = [str(i) for i in ids]
+        self.positions = positions
+        self.codes = codes
+        self.symbols = [str(s) for s in symbols]
+        self.offsets = np.asarray(offsets, dtype=int)
+        self.sites = np.asarray(sites, dtype=int)
+        self.covalent = np.asarray(covalent, dtype=bool) if covalent is not None else None
+        self._index = {frag_id: i for i, frag_id in enumerate(self.ids)}
+    def __len__(self):
+        return len(self.ids)
+    def __contains__(self, frag_id):
+        return frag_id in self._index
+
+    @classmethod
+    def build(cls, xyz_files, ids, sites=None, covalent=None):
+        """
+        Builds the store from single-frame .xyz files
+
+        :param xyz_files, ids: paths to the fragment .xyz files and the matching fragment IDs
+        :param sites: dict of fragment ID -> site number (eg 2 or 11), fragments not in the dict get site 0
+        :param covalent: collection of fragment IDs of the covalent fragments, the others are non-covalent - if None,
+         the store has no covalency metadata and select(covalent=...) refuses to use it
+        """
+        frames = [read_xyz_frames(x) for x in xyz_files]
+        symbols = sorted(set().union(*[f.symbols for f in frames]))
+        codes = [np.array([symbols.index(s) for s in f.symbols], dtype=np.uint8)[f.codes[:f.offsets[1]]] for f in frames]
+        positions = [f.exact_positions[:f.offsets[1]] for f in frames]
+        n_atoms = [len(p) for p in positions]
+        sites = sites if sites is not None else {}
+        covalent = [i in set(covalent) for i in ids] if covalent is not None else None
+        return cls(ids, np.concatenate(positions) if positions else np.empty((0, 3)),
+                   np.concatenate(codes) if codes else np.empty(0, dtype=np.uint8), symbols,
+                   np.concatenate(([0], np.cumsum(n_atoms))), [sites.get(i, 0) for i in ids], covalent)
+
+    def save(self, path):
+        covalent = {'covalent': self.covalent} if self.covalent is not None else {}
+        np.savez(path, ids=np.array(self.ids), positions=self.positions, codes=self.codes,
+                 symbols=np.array(self.symbols), offsets=self.offsets, sites=self.sites, **covalent)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Loads a store saved with FragmentStore.save, memory-mapping the positions and species codes if mmap=True"""
+        with np.load(path) as data:
+            arrays = {key: data[key] for key in ['ids', 'symbols', 'offsets', 'sites', 'covalent'] if key in data.files}
+            if not mmap:
+                arrays['positions'], arrays['codes'] = data['positions'], data['codes']
+        if mmap:
+            arrays['positions'], arrays['codes'] = _memmap_npz(path, 'positions'), _memmap_npz(path, 'codes')
+        return cls(**arrays)
+
+    def index(self, frag_id):
+        return self._index[frag_id]
+    def select(self, site=None, covalent=None):
+        """Returns the IDs of the fragments in a given site and/or of a given covalency"""
+        mask = np.ones(len(self), dtype=bool)
+        if site is not None:
+            mask &= self.sites == site
+        if covalent is not None:
+            if self.covalent is None:
+                raise ValueError('the store has no covalency metadata - build it with the covalent fragment IDs')
+            mask &= self.covalent == bool(covalent)
+        return [self.ids[i] for i in np.flatnonzero(mask)]
+    def get_positions(self, frag_id):
+        i = self._index[frag_id]
+        return self.positions[self.offsets[i]:self.offsets[i+1]]
+    def get_chemical_symbols(self, frag_id):
+        i = self._index[frag_id]
+        return [self.symbols[c] for c in self.codes[self.offsets[i]:self.offsets[i+1]]]
+    def get_frame(self, frag_id):
+        """Returns the fragment as a single-frame XYZFrames, with a float32 copy of the store positions"""
+        i = self._index[frag_id]
+        positions = self.positions[self.offsets[i]:self.offsets[i+1]]
+        return XYZFrames(np.asarray(positions, dtype=np.float32), self.codes[self.offsets[i]:self.offsets[i+1]],
+                         self.symbols, [0, self.offsets[i+1] - self.offsets[i]], [frag_id], positions)
+    def get_atoms(self, frag_id):
+        return self.get_frame(frag_id).get_atoms(0)
+    def get_site_atoms(self, site=None):
+        """
+        Concatenates all fragments of a site (or every fragment if site is None) into one ASE Atoms object - the
+        equivalent of the site2_ligands.xyz/site11_ligands.xyz ligand fields
+
+        :return: atoms, species
+        """
+        ids = self.select(site=site)
+        symbols = [s for frag_id in ids for s in self.get_chemical_symbols(frag_id)]
+        positions = np.concatenate([self.get_positions(frag_id) for frag_id in ids]) if ids else np.empty((0, 3))
+        return Atoms(symbols=symbols, positions=positions), {'C'}.union(symbols)
+
+def _memmap_npz(path, name):
+    """Memory-maps an array stored uncompressed in an .npz archive (as written by np.savez)"""
+    with zipfile.ZipFile(path) as zf:
+        info = zf.getinfo(name + '.npy')
+    assert info.compress_type == zipfile.ZIP_STORED, 'can only memory-map uncompressed .npz files'
+    with open(path, 'rb') as fs:
+        # skip the zip local file header, then read the .npy header
+        fs.seek(info.header_offset)
+        name_len, extra_len = struct.unpack('<HH', fs.read(30)[26:30])
+        fs.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(fs)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fs)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fs)
+        offset = fs.tell()
+    if np.prod(shape) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape, offset=offset, order='F' if fortran_order else 'C')
 
 def split_by_lengths(seq, num):
     out_list = []
@@ -128,6 +224,28 @@ def split_by_lengths(seq, num):
         i+=j
     return out_list
 
+def pack_bytes(items):
+    """
+    Packs a list of byte strings into one uint8 buffer plus offsets, for sending over MPI without pickling
+
+    :return: buf, offsets - item i is buf[offsets[i]:offsets[i+1]]
+    """
+    offsets = np.concatenate(([0], np.cumsum([len(item) for item in items]))).astype(np.int64)
+    return np.frombuffer(b''.join(items), dtype=np.uint8).copy(), offsets
+
+def unpack_bytes(buf, offsets):
+    """Inverse of pack_bytes"""
+    data = np.asarray(buf, dtype=np.uint8).tobytes()
+    return [data[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
+
+def pack_smiles(smiles):
+    """Packs a list of SMILES into one uint8 buffer plus offsets, see pack_bytes"""
+    return pack_bytes([smi.encode() for smi in smiles])
+
+def unpack_smiles(buf, offsets):
+    """Inverse of pack_smiles"""
+    return [item.decode() for item in unpack_bytes(buf, offsets)]
+
 def return_borders(index, dat_len, mpi_size):
     mpi_borders = np.linspace(0, dat_len, mpi_size + 1).astype('int')
 